@@ -0,0 +1,260 @@
+"""
+Benchmarks of LBN on synthetic data. Each configuration runs in its own Python process so that
+compile times and peak memory are not affected by the configurations measured before it.
+
+For every configuration the compile time, steady-state latency (median over repeats) and
+throughput of predict, the log likelihood evaluation and train_model are recorded together with
+the peak RSS of the process.
+
+Usage:
+    python benchmark.py run results.json [--m 10 100] [--batch-size 100] [--width 50]
+                                         [--depth 2] [--stoch-n-hidden -1 | 20,20] [--grid]
+    python benchmark.py compare baseline.json results.json [--threshold 0.1]
+    python benchmark.py startup [--width 50] [--depth 2]
+
+Without --grid the axes are swept one at a time around the first value of each axis. compare
+exits with status 1 if any metric got worse by more than the threshold (a relative change).
+startup measures, in a fresh process, the time to import lbn, to construct an LBN, to make its
+first prediction (graph building and compilation) and a second one.
+"""
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+
+AXES = ['m', 'batch_size', 'width', 'depth', 'stoch_n_hidden']
+#True when a larger value is better.
+METRICS = {'build_time': False,
+           'predict_compile_time': False, 'predict_latency': False, 'predict_throughput': True,
+           'log_likelihood_compile_time': False, 'log_likelihood_latency': False,
+           'log_likelihood_throughput': True,
+           'train_compile_time': False, 'train_latency': False, 'train_throughput': True,
+           'peak_rss': False}
+
+
+def _median_time(fn, repeats):
+    """Calls fn once to warm up and returns the median time of repeats calls."""
+    fn()
+    times = []
+    for _ in xrange(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def run_config(config, n_in=10, n_out=2, n_examples=1000, repeats=10, seed=0):
+    """
+    Measures one configuration in the current process.
+
+    :type config: dict.
+    :param config: values of the axes: m, batch_size, width (units per hidden layer), depth
+                (number of LBN hidden layers) and stoch_n_hidden (list of ints).
+
+    :returns: dict of metrics. Times are in seconds, throughputs in examples times samples per
+            second for predict and the log likelihood and in examples per second for training,
+            peak_rss in bytes.
+    """
+    import theano
+    import theano.tensor as T
+    from lbn import LBN
+    from telemetry import peak_rss
+
+    rng = np.random.RandomState(seed)
+    x = rng.randn(n_examples, n_in).astype(theano.config.floatX)
+    y = (np.dot(x, rng.randn(n_in, n_out)) + rng.randn(n_examples, n_out)).astype(
+                                                                            theano.config.floatX)
+    m = config['m']
+    batch_size = config['batch_size']
+    stoch_n_hidden = config['stoch_n_hidden']
+    metrics = {}
+
+    start = time.time()
+    net = LBN(n_in, [config['width']]*config['depth'], n_out, ['linear']*(config['depth'] + 1),
+                ['sigmoid']*(len(stoch_n_hidden) + 1), stoch_n_hidden=stoch_n_hidden)
+    #The graph is built lazily, so it is built here to keep it out of the compile times.
+    net.define_network()
+    metrics['build_time'] = time.time() - start
+
+    x_batch = x[:batch_size]
+    y_batch = y[:batch_size]
+    start = time.time()
+    predict = theano.function([net.x, net.m], net.output)
+    metrics['predict_compile_time'] = time.time() - start
+    metrics['predict_latency'] = _median_time(lambda: predict(x_batch, m), repeats)
+    metrics['predict_throughput'] = x_batch.shape[0]*m/metrics['predict_latency']
+
+    start = time.time()
+    get_log_likelihood = theano.function([net.x, net.y, net.m], net.log_likelihood)
+    metrics['log_likelihood_compile_time'] = time.time() - start
+    metrics['log_likelihood_latency'] = _median_time(
+                                        lambda: get_log_likelihood(x_batch, y_batch, m), repeats)
+    metrics['log_likelihood_throughput'] = x_batch.shape[0]*m/metrics['log_likelihood_latency']
+
+    train_set_x = theano.shared(x)
+    train_set_y = theano.shared(y)
+    net.fiting_variables(batch_size, train_set_x, train_set_y)
+    start = time.time()
+    train_model = net.compile_train_model(m, 0.01, batch_size, n_examples, train_set_x,
+                                                                                    train_set_y)
+    metrics['train_compile_time'] = time.time() - start
+    metrics['train_latency'] = _median_time(lambda: train_model(0, n_examples), repeats)
+    metrics['train_throughput'] = batch_size/metrics['train_latency']
+
+    metrics['peak_rss'] = peak_rss()
+    return metrics
+
+
+def configurations(axes, grid=False):
+    """
+    Returns the list of configurations of a sweep.
+
+    :type axes: dict.
+    :param axes: list of values of each axis.
+
+    :type grid: bool.
+    :param grid: if True all combinations are returned, otherwise each axis is varied alone
+                with the other axes at their first value.
+    """
+    if grid:
+        return [dict(zip(AXES, values)) for values in itertools.product(*[axes[a] for a in AXES])]
+    base = dict((a, axes[a][0]) for a in AXES)
+    configs = [base]
+    for a in AXES:
+        configs.extend(dict(base, **{a: value}) for value in axes[a][1:])
+    return configs
+
+
+def startup_times(width=50, depth=2, n_in=10, n_out=2):
+    """
+    Measures the start up costs of lbn in the current process, which must not have imported it.
+
+    :returns: dict with the seconds spent importing lbn, constructing an LBN and calling predict
+            for the first and second time.
+    """
+    start = time.time()
+    from lbn import LBN
+    times = {'import_time': time.time() - start}
+    start = time.time()
+    net = LBN(n_in, [width]*depth, n_out, ['linear']*(depth + 1), ['sigmoid', 'sigmoid'])
+    times['construct_time'] = time.time() - start
+    x = np.zeros((10, n_in))
+    for key in ('first_predict_time', 'second_predict_time'):
+        start = time.time()
+        net.predict(x, 10)
+        times[key] = time.time() - start
+    return times
+
+
+def environment():
+    import theano
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'theano': theano.__version__, 'floatX': theano.config.floatX,
+            'device': theano.config.device, 'machine': platform.machine(),
+            'processor': platform.processor(), 'node': platform.node()}
+
+
+def run(axes, fname, grid=False, repeats=10):
+    """Measures every configuration in a subprocess and writes the results to fname."""
+    results = []
+    for config in configurations(axes, grid):
+        print "Benchmarking {0}".format(json.dumps(config, sort_keys=True))
+        process = subprocess.Popen([sys.executable, __file__, 'config', json.dumps(config),
+                                    '--repeats', str(repeats)], stdout=subprocess.PIPE)
+        out, _ = process.communicate()
+        if process.returncode != 0:
+            print "Configuration failed with status {0}".format(process.returncode)
+            results.append({'config': config, 'error': process.returncode})
+            continue
+        metrics = json.loads(out.strip().split('\n')[-1])
+        print "    " + ", ".join("{0}: {1:.4g}".format(k, metrics[k]) for k in sorted(metrics))
+        results.append({'config': config, 'metrics': metrics})
+    with open(fname, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=1,
+                                                                                sort_keys=True)
+    return results
+
+
+def compare(baseline_fname, fname, threshold=0.1):
+    """
+    Compares the metrics of the configurations present in both files.
+
+    :returns: list of (config, metric, baseline value, value, relative change) of the metrics
+            that got worse by more than threshold.
+    """
+    def load(fname):
+        with open(fname) as f:
+            return dict((json.dumps(r['config'], sort_keys=True), r.get('metrics'))
+                                                                for r in json.load(f)['results'])
+    baseline = load(baseline_fname)
+    results = load(fname)
+    regressions = []
+    for config in sorted(set(baseline) & set(results)):
+        if baseline[config] is None or results[config] is None:
+            continue
+        for metric, higher_is_better in sorted(METRICS.items()):
+            old = baseline[config].get(metric)
+            new = results[config].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old)/old
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                regressions.append((config, metric, old, new, change))
+                flag = '  REGRESSION'
+            print "{0} {1}: {2:.4g} -> {3:.4g} ({4:+.1%}){5}".format(config, metric, old, new,
+                                                                                    change, flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="LBN benchmarks.")
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help="run a sweep and write the results")
+    run_parser.add_argument('output')
+    run_parser.add_argument('--m', type=int, nargs='+', default=[10, 100])
+    run_parser.add_argument('--batch-size', type=int, nargs='+', default=[100, 1000])
+    run_parser.add_argument('--width', type=int, nargs='+', default=[50, 200])
+    run_parser.add_argument('--depth', type=int, nargs='+', default=[2, 4])
+    run_parser.add_argument('--stoch-n-hidden', nargs='+', default=['-1', '50,50'],
+                            help="comma separated hidden units of the stochastic MLP")
+    run_parser.add_argument('--grid', action='store_true', help="run all combinations")
+    run_parser.add_argument('--repeats', type=int, default=10)
+    compare_parser = subparsers.add_parser('compare', help="compare two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    startup_parser = subparsers.add_parser('startup', help="measure import and start up times")
+    startup_parser.add_argument('--width', type=int, default=50)
+    startup_parser.add_argument('--depth', type=int, default=2)
+    config_parser = subparsers.add_parser('config', help="measure one configuration (internal)")
+    config_parser.add_argument('config')
+    config_parser.add_argument('--repeats', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        axes = {'m': args.m, 'batch_size': args.batch_size, 'width': args.width,
+                'depth': args.depth,
+                'stoch_n_hidden': [[int(h) for h in s.split(',')] for s in args.stoch_n_hidden]}
+        run(axes, args.output, grid=args.grid, repeats=args.repeats)
+    elif args.command == 'startup':
+        times = startup_times(args.width, args.depth)
+        print ", ".join("{0}: {1:.3f}s".format(k, times[k]) for k in sorted(times))
+    elif args.command == 'compare':
+        regressions = compare(args.baseline, args.results, args.threshold)
+        print "{0} regressions".format(len(regressions))
+        return 1 if regressions else 0
+    else:
+        metrics = run_config(json.loads(args.config), repeats=args.repeats)
+        #The last line of the output is read by run().
+        print json.dumps(metrics)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""
+Reading and writing of the network descriptions generated by LBN.network_description().
+
+Two formats are supported:
+    - JSON: a single file where the weights are nested lists, as written by the original
+      LBN.save_network().
+    - Binary: a directory with one raw .npy file per weight array and a small manifest.json that
+      has the same layout as the JSON file, with every array replaced by {"npy": file name}.
+      The arrays can be memory-mapped when loading.
+"""
+import json
+import os
+import shutil
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+
+def _to_json(obj):
+    """json default hook for numpy arrays and scalars."""
+    return obj.tolist()
+
+
+def _is_complete(dirname):
+    return os.path.isdir(dirname) and os.path.isfile(os.path.join(dirname, MANIFEST))
+
+
+def _resolve(fname):
+    """
+    Returns the directory that holds the binary checkpoint fname. An atomic save_binary()
+    interrupted between its two renames leaves the previous checkpoint in fname + '.old' only.
+    """
+    old = fname.rstrip(os.sep) + '.old'
+    if not _is_complete(fname) and _is_complete(old):
+        return old
+    return fname
+
+
+def is_binary_checkpoint(fname):
+    """
+    Returns True if fname is a directory written by save_binary(), or if an interrupted atomic
+    save left its previous version in fname + '.old'.
+    """
+    return _is_complete(_resolve(fname))
+
+
+def save_json(network_description, fname):
+    """
+    Saves a network description to a JSON file.
+
+    :type network_description: dict.
+    :param network_description: network as generated in LBN.network_description().
+
+    :type fname: string.
+    :param fname: file name (with local or global path) where to store the network.
+    """
+    with open(fname, 'w') as f:
+        json.dump(network_description, f, default=_to_json)
+
+
+def save_binary(network_description, dirname, atomic=False):
+    """
+    Saves a network description to a directory of .npy arrays plus a JSON manifest.
+
+    :type network_description: dict.
+    :param network_description: network as generated in LBN.network_description().
+
+    :type dirname: string.
+    :param dirname: directory (with local or global path) where to store the network. It is
+                    created if it does not exist.
+
+    :type atomic: bool.
+    :param atomic: if True the checkpoint is written to a temporary directory that then replaces
+                dirname, so that an interrupted save does not corrupt an existing checkpoint.
+                The previous checkpoint is moved to dirname + '.old' during the swap, where
+                load() and is_binary_checkpoint() find it if the swap is interrupted.
+    """
+    if atomic:
+        tmp = dirname.rstrip(os.sep) + '.tmp'
+        old = dirname.rstrip(os.sep) + '.old'
+        #If an earlier save was interrupted between the renames, old is the only checkpoint.
+        if _resolve(dirname) == old:
+            if os.path.isdir(dirname):
+                shutil.rmtree(dirname)
+            os.rename(old, dirname)
+        for d in (tmp, old):
+            if os.path.isdir(d):
+                shutil.rmtree(d)
+        save_binary(network_description, tmp)
+        if os.path.isdir(dirname):
+            os.rename(dirname, old)
+        os.rename(tmp, dirname)
+        if os.path.isdir(old):
+            shutil.rmtree(old)
+        return
+
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    def replace_arrays(obj, path):
+        if isinstance(obj, np.ndarray):
+            fname = '.'.join(path) + '.npy'
+            np.save(os.path.join(dirname, fname), obj)
+            return {'npy': fname}
+        elif isinstance(obj, dict):
+            return dict((k, replace_arrays(v, path + [k])) for k, v in obj.iteritems())
+        elif isinstance(obj, list):
+            return [replace_arrays(v, path + [str(i)]) for i, v in enumerate(obj)]
+        return obj
+
+    manifest = replace_arrays(network_description, [])
+    with open(os.path.join(dirname, MANIFEST), 'w') as f:
+        json.dump(manifest, f, default=_to_json)
+
+
+def load(fname, mmap=False):
+    """
+    Loads a network description saved in any of the supported formats.
+
+    :type fname: string.
+    :param fname: JSON file or binary checkpoint directory from where to load the network. If
+                an atomic save_binary() was interrupted, the previous checkpoint is loaded.
+
+    :type mmap: bool.
+    :param mmap: if True the arrays of a binary checkpoint are memory-mapped copy-on-write
+                instead of read into memory. Ignored for JSON files.
+
+    :returns: dict with the 'network_properties' and 'layers' keys. Weights are numpy arrays in
+            binary checkpoints and nested lists in JSON files.
+    """
+    if not is_binary_checkpoint(fname):
+        with open(fname) as f:
+            return json.load(f)
+
+    fname = _resolve(fname)
+    with open(os.path.join(fname, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    def load_arrays(obj):
+        if isinstance(obj, dict):
+            if obj.keys() == ['npy']:
+                return np.load(os.path.join(fname, obj['npy']), mmap_mode='c' if mmap else None)
+            return dict((k, load_arrays(v)) for k, v in obj.iteritems())
+        elif isinstance(obj, list):
+            return [load_arrays(v) for v in obj]
+        return obj
+
+    return load_arrays(manifest)
+
+
+def random_state_description(random_state):
+    """Returns the state of a numpy.random.RandomState as a dict that save_binary() can store."""
+    _, keys, pos, has_gauss, cached_gaussian = random_state.get_state()
+    return {'keys': keys, 'pos': int(pos), 'has_gauss': int(has_gauss),
+            'cached_gaussian': float(cached_gaussian)}
+
+
+def set_random_state(random_state, description):
+    """Restores a state returned by random_state_description() into a RandomState."""
+    random_state.set_state(('MT19937', np.asarray(description['keys'], dtype=np.uint32),
+                            description['pos'], description['has_gauss'],
+                            description['cached_gaussian']))
+
+
+def convert(src, dst, binary=True):
+    """
+    Converts a saved network between the JSON and the binary formats.
+
+    :type src: string.
+    :param src: JSON file or binary checkpoint directory to read.
+
+    :type dst: string.
+    :param dst: destination file or directory.
+
+    :type binary: bool.
+    :param binary: if True dst is written as a binary checkpoint, otherwise as a JSON file.
+    """
+    network_description = load(src)
+    if binary:
+        #JSON files hold nested lists, so the weights are turned into arrays first.
+        for layer in network_description['layers']['hidden_layers']:
+            for l in [layer['LBNlayer']['detLayer']] + \
+                                    [h['detLayer'] for h in layer['LBNlayer']['stochLayer']]:
+                l['W'] = np.asarray(l['W'])
+                if l['b'] is not None:
+                    l['b'] = np.asarray(l['b'])
+        output_layer = network_description['layers']['output_layer']
+        output_layer['W'] = np.asarray(output_layer['W'])
+        save_binary(network_description, dst)
+    else:
+        save_json(network_description, dst)
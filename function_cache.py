@@ -0,0 +1,176 @@
+"""
+Cache of compiled Theano functions shared by networks with the same architecture.
+
+A compiled function only depends on the graph, so two LBNs with the same architecture, floatX and
+training settings can use the same compiled function applied to their own shared variables. The
+cache pickles every compiled function once, with its shared variables (weights, random states,
+datasets) stored as references to their position in a list. Unpickling it against the list of
+another network gives the function for that network without optimizing nor compiling the graph
+again. The pickles can also be stored in a directory to be reused by other processes.
+"""
+import cPickle
+import cStringIO
+import hashlib
+import json
+import os
+import sys
+import time
+import warnings
+import theano
+
+#Version of the pickle format, part of the keys so that pickles of another format are not loaded.
+CACHE_VERSION = 2
+
+
+def dumps(fn, shared_variables):
+    """
+    Pickles the compiled function fn. The shared variables, their containers, the storage of their
+    containers and their values are replaced by their index in shared_variables. The function has
+    its own containers around the storage of the shared variables, which must stay shared so that
+    the function sees the values set after it is loaded.
+    """
+    references = {}
+    for i, s in enumerate(shared_variables):
+        references[id(s)] = 'shared:{0}'.format(i)
+        references[id(s.container)] = 'container:{0}'.format(i)
+        references[id(s.container.storage)] = 'storage:{0}'.format(i)
+        references[id(s.container.data)] = 'data:{0}'.format(i)
+
+    f = cStringIO.StringIO()
+    pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = lambda obj: references.get(id(obj))
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 50000))
+    try:
+        pickler.dump(fn)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    return f.getvalue()
+
+
+def loads(data, shared_variables):
+    """
+    Unpickles a function pickled with dumps() so that it uses shared_variables.
+    """
+    def persistent_load(reference):
+        kind, i = reference.split(':')
+        s = shared_variables[int(i)]
+        return {'shared': s, 'container': s.container, 'storage': s.container.storage,
+                'data': s.container.data}[kind]
+
+    unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+class FunctionCache(object):
+    def __init__(self, cache_dir=None):
+        """
+        :type cache_dir: string.
+        :param cache_dir: directory where compiled functions are pickled. If None functions are only
+                        cached in memory.
+        """
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.functions = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.compile_time = 0.
+        self.time_saved = 0.
+
+    @staticmethod
+    def make_key(name, architecture, settings=None):
+        """
+        Returns the hash that identifies a compiled function.
+
+        :type name: string.
+        :param name: name of the function, e.g. 'predict' or 'train_model'.
+
+        :type architecture: dict.
+        :param architecture: properties that define the graph of the network.
+
+        :type settings: dict.
+        :param settings: values that are embedded in the graph as constants, e.g. learning rate.
+        """
+        description = {'name': name, 'architecture': architecture, 'settings': settings or {},
+                       'floatX': theano.config.floatX, 'device': theano.config.device,
+                       'mode': str(theano.config.mode), 'theano': theano.__version__,
+                       'cache_version': CACHE_VERSION}
+        return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.isfile(self._path(key)):
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return cPickle.load(f)
+        except Exception as e:
+            warnings.warn("Could not load cached function {0}: {1}".format(key, e))
+            return None
+
+    def _dump(self, key, entry):
+        if self.cache_dir is None:
+            return
+        tmp = self._path(key) + '.{0}.tmp'.format(os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, self._path(key))
+        except (IOError, OSError) as e:
+            warnings.warn("Could not store compiled function {0}: {1}".format(key, e))
+
+    def function(self, key, shared_variables, compile_function):
+        """
+        Returns the compiled function of key applied to shared_variables.
+
+        :type key: string.
+        :param key: key of the function as returned by make_key().
+
+        :type shared_variables: list of theano.SharedVariable.
+        :param shared_variables: all the shared variables the function may use, always in the same
+                                order for a given key.
+
+        :type compile_function: function.
+        :param compile_function: function without arguments that compiles the function on a miss.
+        """
+        start = time.time()
+        entry = self.functions.get(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is not None:
+                self.disk_hits += 1
+                self.functions[key] = entry
+        else:
+            self.hits += 1
+
+        if entry is not None:
+            fn = loads(entry['function'], shared_variables)
+            self.time_saved += max(entry['compile_time'] - (time.time() - start), 0.)
+            return fn
+
+        self.misses += 1
+        fn = compile_function()
+        elapsed = time.time() - start
+        self.compile_time += elapsed
+        ids = set(id(s) for s in shared_variables)
+        if not all(id(s) in ids for s in fn.get_shared()):
+            warnings.warn("Function {0} uses shared variables that are not cached".format(key))
+            return fn
+        try:
+            entry = {'function': dumps(fn, shared_variables), 'compile_time': elapsed}
+        except (cPickle.PicklingError, TypeError, RuntimeError) as e:
+            warnings.warn("Could not pickle compiled function {0}: {1}".format(key, e))
+            return fn
+        self.functions[key] = entry
+        self._dump(key, entry)
+        return fn
+
+    def report(self):
+        """Returns the hit and miss counters, compilation time and time saved in seconds."""
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'compile_time': self.compile_time, 'time_saved': self.time_saved}
@@ -1,17 +1,40 @@
+import sys
+import time
+import warnings
 import theano
+import theano.sparse
 import theano.tensor as T
 import numpy as np
-import matplotlib.pyplot as plt
+import scipy.sparse
 import types
 from types import IntType
 from types import ListType
 from types import FloatType
-import json
-from util import parse_activations
+from noise import NOISE, uniform_noise
+from util import dot, parse_activations
+import checkpoint
+import optimizers
+import parallel
+import planner
+import streaming
+import summary
+import telemetry
+
+
+def _weight_values(values, copy=True):
+    """
+    Returns the weights of a network description as an array. If copy is False an array, e.g. a
+    memory-mapped one, is returned without copying it. None, the bias of a layer without bias,
+    is returned as is.
+    """
+    if values is None:
+        return None
+    return np.array(values, copy=copy)
 
 
 class OutputLayer(object):
-    def __init__(self, rng, input_var, n_in, n_out, activation, activation_name, V_values=None):
+    def __init__(self, rng, input_var, n_in, n_out, activation, activation_name, V_values=None,
+                                                                                vectorized=True):
         """
         LBN output layer.
         :type rng: numpy.random.RandomState.
@@ -34,6 +57,10 @@ class OutputLayer(object):
 
         :type V: numpy.array.
         :param V: initialization values of the weights.
+
+        :type vectorized: bool.
+        :param vectorized: if True the m samples are processed in a single batched product,
+                        otherwise theano.scan iterates over them.
         """
         self.input = input_var
         if V_values is None:
@@ -60,12 +87,17 @@ class OutputLayer(object):
             a = T.dot(x, self.W.T)
             output = self.activation(a)
             return a, output
-        [self.a, self.output], _ = theano.scan(h_step, sequences=[self.input])
-        
+
+        if vectorized:
+            self.a, self.output = h_step(self.input)
+        else:
+            [self.a, self.output], _ = theano.scan(h_step, sequences=[self.input])
+
 
 class DetHiddenLayer(object):
     def __init__(self, rng, input_var, n_in, n_out, activation, activation_name,
-                                            m=None, W_values=None, b_values=None, no_bias=False):
+                                            m=None, W_values=None, b_values=None, no_bias=False,
+                                            vectorized=True):
         """
         Deterministic hidden layer: Weight matrix W is of shape (n_out,n_in)
         and the bias vector b is of shape (n_out,).
@@ -73,7 +105,8 @@ class DetHiddenLayer(object):
         :param rng: a random number generator used to initialize weights.
 
         :type input_var: theano.tensor.dmatrix.
-        :param input_var: a symbolic tensor of shape (n_samples, n_in) or (m, n_samples, n_in).
+        :param input_var: a symbolic tensor of shape (n_samples, n_in) or (m, n_samples, n_in). A
+                        sparse matrix of shape (n_samples, n_in) is also accepted.
 
         :type n_in: int.
         :param n_in: input dimensionality.
@@ -99,6 +132,10 @@ class DetHiddenLayer(object):
 
         :type no_bias: bool.
         :param no_bias: sets if the layer has bias variable or not.
+
+        :type vectorized: bool.
+        :param vectorized: if True the m samples are processed in a single batched product,
+                        otherwise theano.scan iterates over them.
         """
         self.input = input_var
         self.no_bias = no_bias
@@ -134,7 +171,7 @@ class DetHiddenLayer(object):
         self.activation = activation
 
         def h_step(x):
-            no_bias_output = T.dot(x, self.W.T)
+            no_bias_output = dot(x, self.W.T)
             if self.no_bias:
                 a = no_bias_output
             else:
@@ -142,13 +179,16 @@ class DetHiddenLayer(object):
             output = self.activation(a)
             return no_bias_output, a, output
 
-        if m is None:
-            [self.no_bias_output, self.a, self.output], _ = theano.scan(
-                                                                h_step, sequences=self.input)
+        if vectorized or m is not None:
+            outputs = h_step(self.input)
+            if m is not None:
+                #The input is the same for all the samples, so it is projected once and
+                #broadcasted along the m axis.
+                outputs = [T.alloc(o, m, o.shape[0], o.shape[1]) for o in outputs]
+            [self.no_bias_output, self.a, self.output] = outputs
         else:
             [self.no_bias_output, self.a, self.output], _ = theano.scan(
-                                                                h_step, non_sequences=self.input,
-                                                                outputs_info=[None]*3, n_steps=m)
+                                                                h_step, sequences=self.input)
 
 
 class StochHiddenLayer(object):
@@ -156,7 +196,9 @@ class StochHiddenLayer(object):
     Stochastic hidden MLP that are included in each LBN hidden layer.
     """
     def __init__(self, rng, trng, input_var, n_in, n_hidden, n_out, activations, activation_names,
-                                                                                    mlp_info=None):
+                                                                    mlp_info=None, m=None,
+                                                                    vectorized=True, noise='iid',
+                                                                    copy=True):
         """
         :type rng: numpy.random.RandomState.
         :param rng: a random number generator used to initialize weights.
@@ -185,6 +227,20 @@ class StochHiddenLayer(object):
         :type mlp_info: dict.
         :param mlp_info: dictionary containing the information of the mlp as generated in
                         LBN.save_network().
+
+        :type m: int.
+        :param m: number of samples to be drawn when input_var is of shape (n_examples, n_in) and
+                is shared by all the samples. If None, input_var is of shape (m, n_examples, n_in).
+
+        :type vectorized: bool.
+        :param vectorized: if True the m samples are processed in a single batched product,
+                        otherwise theano.scan iterates over them.
+
+        :type noise: string.
+        :param noise: generator of the uniform noise of the Bernoulli units, see noise.NOISE.
+
+        :type copy: bool.
+        :param copy: if False the layers use the arrays of mlp_info without copying them.
         """
 
         self.input = input_var
@@ -202,17 +258,19 @@ class StochHiddenLayer(object):
                 self.hidden_layers[i] = DetHiddenLayer(rng, self.input, self.n_in, h,
                                                             activations[i], activation_names[i],
                                                             W_values=None if mlp_info is None else
-                                                            np.array(mlp_info[i]['detLayer']['W']),
+                                                _weight_values(mlp_info[i]['detLayer']['W'], copy),
                                                             b_values=None if mlp_info is None else
-                                                            np.array(mlp_info[i]['detLayer']['b']))
+                                                _weight_values(mlp_info[i]['detLayer']['b'], copy),
+                                                            vectorized=vectorized)
             else:
                 self.hidden_layers[i] = DetHiddenLayer(rng, self.hidden_layers[i-1].output,
                                                             self.n_hidden[i-1], h,
                                                             activations[i], activation_names[i],
                                                             W_values=None if mlp_info is None else
-                                                            np.array(mlp_info[i]['detLayer']['W']),
+                                                _weight_values(mlp_info[i]['detLayer']['W'], copy),
                                                             b_values=None if mlp_info is None else
-                                                            np.array(mlp_info[i]['detLayer']['b']))
+                                                _weight_values(mlp_info[i]['detLayer']['b'], copy),
+                                                            vectorized=vectorized)
             self.params[2*i] = self.hidden_layers[i].W
             self.params[2*i+1] = self.hidden_layers[i].b
 
@@ -221,23 +279,30 @@ class StochHiddenLayer(object):
                                                     self.n_hidden[-1], self.n_out,
                                                     activations[-1], activation_names[-1],
                                                     W_values=None if mlp_info is None else
-                                                            np.array(mlp_info[-1]['detLayer']['W']),
+                                                _weight_values(mlp_info[-1]['detLayer']['W'], copy),
                                                     b_values=None if mlp_info is None else
-                                                            np.array(mlp_info[-1]['detLayer']['b']))
+                                                _weight_values(mlp_info[-1]['detLayer']['b'], copy),
+                                                    vectorized=vectorized)
         self.params[-2] = self.hidden_layers[-1].W
         self.params[-1] = self.hidden_layers[-1].b
 
         #Sample from a Bernoulli distribution in each unit with a probability equal to the MLP
         #ouput.
         self.ph = self.hidden_layers[-1].output
-        sample = trng.uniform(size=self.ph.shape)
+        if m is None:
+            ph = self.ph
+            sample = uniform_noise(trng, (ph.shape[0], ph.shape[1], n_out), noise)
+        else:
+            #ph is the same for all the samples, only the uniform draws change along the m axis.
+            ph = self.ph.dimshuffle('x', 0, 1)
+            sample = uniform_noise(trng, (m, self.ph.shape[0], n_out), noise)
 
         #Gradient that will be used is the one defined as "G3" in "Techniques for Learning Binary
         #stochastic feedforward Neural Networks" by Tapani Raiko, Mathias Berglund, Guillaum Alain
         #and Laurent Dinh. For this we need to propagate the gradient in the stochastic units
         #through ph. For this reason we use disconnected_grad() in epsilon.
-        epsilon = theano.gradient.disconnected_grad(T.lt(sample, self.ph) - self.ph)
-        self.output = self.ph + epsilon
+        epsilon = theano.gradient.disconnected_grad(T.lt(sample, ph) - ph)
+        self.output = ph + epsilon
 
 
 class LBNHiddenLayer():
@@ -247,7 +312,8 @@ class LBNHiddenLayer():
     def __init__(self, rng, trng, input_var, n_in, n_out, det_activation,
                                 stoch_n_hidden, stoch_activations,
                                 det_activation_name=None, stoch_activation_names=None, m=None,
-                                det_W=None, det_b=None, stoch_mlp_info=None):
+                                det_W=None, det_b=None, stoch_mlp_info=None, vectorized=True,
+                                noise='iid', copy=True):
         """
         :type rng: numpy.random.RandomState
         :param rng: a random number generator used to initialize weights.
@@ -291,6 +357,17 @@ class LBNHiddenLayer():
         :type stoch_mlp_info: dict.
         :param stoch_mlp_info: dictionary containing the information of the mlp as generated in
                             LBN.save_network().
+
+        :type vectorized: bool.
+        :param vectorized: if True the m samples are processed in a single batched product,
+                        otherwise theano.scan iterates over them.
+
+        :type noise: string.
+        :param noise: generator of the uniform noise of the Bernoulli units, see noise.NOISE.
+
+        :type copy: bool.
+        :param copy: if False the stochastic MLP uses the arrays of stoch_mlp_info without copying
+                    them.
         """
 
         self.input = input_var
@@ -299,20 +376,52 @@ class LBNHiddenLayer():
         self.det_activation = det_activation_name
         self.stoch_activation = stoch_activation_names
         self.m = m
+        #In vectorized mode an input shared by all the samples is kept 2D through the deterministic
+        #layer and the stochastic MLP. The m axis only appears when drawing the Bernoulli samples.
         self.det_layer = DetHiddenLayer(rng, input_var, n_in, n_out, det_activation,
-                                        det_activation_name, m=m, no_bias=True, 
-                                        W_values=det_W, b_values=det_b)
+                                        det_activation_name, m=None if vectorized else m,
+                                        no_bias=True, W_values=det_W, b_values=det_b,
+                                        vectorized=vectorized)
            
         #If -1, same hidden units
         stoch_n_hidden = np.array([i if i > -1 else n_out for i in stoch_n_hidden])
         self.stoch_layer = StochHiddenLayer(rng, trng, self.det_layer.no_bias_output,
                                                     n_out, stoch_n_hidden, n_out,
                                                     stoch_activations, stoch_activation_names,
-                                                    mlp_info=stoch_mlp_info)
+                                                    mlp_info=stoch_mlp_info,
+                                                    m=m if vectorized else None,
+                                                    vectorized=vectorized, noise=noise, copy=copy)
 
-        self.output = self.stoch_layer.output*self.det_layer.output
+        if vectorized and m is not None:
+            self.output = self.stoch_layer.output*self.det_layer.output.dimshuffle('x', 0, 1)
+        else:
+            self.output = self.stoch_layer.output*self.det_layer.output
         self.params = self.det_layer.params + self.stoch_layer.params
 
+    def mean_field(self, mean, variance, det_activation_prime):
+        """
+        Mean-field pass of the layer: the Bernoulli units are replaced by their probabilities ph.
+        Takes the mean and variance of the input units, matrices of shape (n_examples, n_in), and
+        returns those of the output units. variance is None for the input of the network. The
+        units are treated as independent, the deterministic activation is linearized around the
+        mean of its input and the stochastic MLP is evaluated at the mean of its input.
+
+        :type det_activation_prime: function.
+        :param det_activation_prime: derivative of the deterministic activation.
+        """
+        det = self.det_layer
+        a_mean = dot(mean, det.W.T)
+        a_variance = 0. if variance is None else T.dot(variance, (det.W**2).T)
+        det_mean = det.activation(a_mean)
+        det_variance = det_activation_prime(a_mean)**2*a_variance
+        ph = a_mean
+        for layer in self.stoch_layer.hidden_layers:
+            ph = layer.activation(T.dot(ph, layer.W.T) + layer.b)
+        #The output is the product of a Bernoulli(ph) gate and the deterministic unit.
+        output_mean = ph*det_mean
+        output_variance = ph*(det_variance + det_mean**2) - output_mean**2
+        return output_mean, output_variance
+
 
 class LBN:
     """
@@ -321,7 +430,9 @@ class LBN:
     Research.
     """
     def __init__(self, n_in, n_hidden, n_out, det_activations, stoch_activations,
-                                                        stoch_n_hidden=[-1], keep_undefined=False):
+                                                        stoch_n_hidden=[-1], keep_undefined=False,
+                                                        vectorized=True, function_cache=None,
+                                                        noise='iid', sparse=False):
         """
         :type n_in: int.
         :param n_in: input dimensionality of the network.
@@ -348,13 +459,44 @@ class LBN:
 
         :type keep_undefined: bool.
         :param keep_undefined: used when loading network from file. Does not create the graph,
-                            just the general network definition variables.
+                            just the general network definition variables. Otherwise the graph is
+                            built by define_network() the first time it is used.
+
+        :type vectorized: bool.
+        :param vectorized: if True the m samples are processed with batched products over
+                        (m, n_samples, n) tensors. If False each layer iterates over the samples
+                        with theano.scan. Both modes draw the same random numbers and give the
+                        same results.
+
+        :type function_cache: function_cache.FunctionCache.
+        :param function_cache: if set, compiled functions are taken from this cache when a network
+                            with the same architecture and settings compiled them before.
+
+        :type noise: string.
+        :param noise: generator of the uniform noise that samples the Bernoulli units, used in
+                    training and prediction. One of 'iid', 'stratified', 'antithetic' and 'halton'.
+                    The last three spread the m samples of each unit more evenly, which lowers the
+                    variance of the estimates for a given m. See the noise module and
+                    estimator_variance().
+
+        :type sparse: bool.
+        :param sparse: if True the input x is a scipy.sparse CSR matrix in fit(), partial_fit(),
+                    predict() and the other compiled functions. Only the first layer projection
+                    touches it, with a sparse-dense product computed once for all the samples.
         """
-        self.x = T.matrix('x', dtype=theano.config.floatX)
+        if sparse:
+            self.x = theano.sparse.csr_matrix('x', dtype=theano.config.floatX)
+        else:
+            self.x = T.matrix('x', dtype=theano.config.floatX)
+        self.sparse = sparse
         self.y = T.matrix('y', dtype=theano.config.floatX)
         self.trng = T.shared_randomstreams.RandomStreams(1234)
         self.rng = np.random.RandomState(0)
         self.m = T.lscalar('M') 
+        self.vectorized = vectorized
+        self.function_cache = function_cache
+        self.noise = noise
+        assert noise in NOISE, "noise must be one of {0}: {1!r}".format(list(NOISE), noise)
         assert type(n_in) is IntType, "n_in must be an integer: {0!r}".format(n_in)
         assert type(n_hidden) is ListType, "n_hidden must be a list: {0!r}".format(n_hidden)
         assert type(n_out) is IntType, "n_out must be an integer: {0!r}".format(n_out)
@@ -367,7 +509,7 @@ class LBN:
                                                                          format(stoch_activations)
         assert type(stoch_n_hidden) is ListType, "stoch_n_hidden must be a list: {0!r}".format(
                                                                                     stoch_n_hidden)
-        assert stoch_n_hidden == [-1] or len(stoch_n_hidden) == len(stoch_activation) - 1, \
+        assert stoch_n_hidden == [-1] or len(stoch_n_hidden) == len(stoch_activations) - 1, \
                 "len(stoch_n_hidden) must be len(stoch_activations) -1 or stoch_n_hidden = [-1]."\
                 " stoch_n_hidden = {0!r} and stoch_activations = {1!r}".format(stoch_n_hidden,
                                                                                 stoch_activations)
@@ -375,7 +517,40 @@ class LBN:
         self.parse_properties(n_in, n_hidden, n_out, det_activations, stoch_activations,
                                                                                     stoch_n_hidden)
         if not keep_undefined:
-            self.define_network()
+            self._pending_layers = None
+
+    #Attributes created by define_network(). The graph is built when one of them is first used.
+    GRAPH_ATTRIBUTES = ('hidden_layers', 'params', 'output_layer', 'output',
+                        'example_log_sum_exp', 'log_likelihood', 'mean_output', 'output_variance')
+    #Functions compiled when first used: name -> (names of the inputs, names of the outputs).
+    #predict(x, m) returns m samples of the output. predict_mean(x) and predict_moments(x) are the
+    #single pass mean-field approximations of their mean and of their mean and variance.
+    LAZY_FUNCTIONS = {'predict': (('x', 'm'), 'output'),
+                      'predict_mean': (('x',), 'mean_output'),
+                      'predict_moments': (('x',), ('mean_output', 'output_variance')),
+                      'get_log_likelihood': (('x', 'y', 'm'), 'log_likelihood'),
+                      'get_example_log_sum_exp': (('x', 'y', 'm'), 'example_log_sum_exp'),
+                      'get_batch_size': (('index', 'n_ex'), 'effective_batch_size')}
+
+    def __getattr__(self, name):
+        #Only called for missing attributes: builds the graph or compiles a function on first use.
+        if name in LBN.GRAPH_ATTRIBUTES and '_pending_layers' in self.__dict__:
+            self.define_network(self.__dict__['_pending_layers'],
+                                                        self.__dict__.get('_pending_copy', True))
+            return getattr(self, name)
+        if name in LBN.LAZY_FUNCTIONS:
+            inputs, output = LBN.LAZY_FUNCTIONS[name]
+            kwargs = {'inputs': [getattr(self, i) for i in inputs],
+                      'outputs': [getattr(self, o) for o in output] if type(output) is tuple
+                                                                    else getattr(self, output)}
+            if name == 'get_batch_size':
+                #The batch size is a constant of this graph, so it is not cached.
+                fn = theano.function(**kwargs)
+            else:
+                fn = self.compile_function(name, **kwargs)
+            setattr(self, name, fn)
+            return fn
+        raise AttributeError(name)
 
     def parse_properties(self, n_in, n_hidden, n_out, det_activations, stoch_activations,
                                                                                 stoch_n_hidden):
@@ -388,10 +563,23 @@ class LBN:
         self.stoch_activation_names = stoch_activations 
         self.stoch_activation, self.stoch_activation_prime = parse_activations(stoch_activations)    
 
-    def define_network(self, layers_info=None):
+    def define_network(self, layers_info=None, copy=True):
         """
-        Builds Theano graph of the network.
+        Builds Theano graph of the network. It is called on first use of the graph, so it only
+        needs to be called explicitly for networks created with keep_undefined.
+
+        :type layers_info: dict.
+        :param layers_info: 'layers' of a network description with the initial weights. If None
+                            the weights are initialized randomly.
+
+        :type copy: bool.
+        :param copy: if False the shared variables use the arrays of layers_info without copying
+                    them, so that changing the weights of the network changes layers_info.
         """
+        self.__dict__.pop('_pending_layers', None)
+        self.__dict__.pop('_pending_copy', None)
+        for name in LBN.LAZY_FUNCTIONS.keys() + ['_partial_fit']:
+            self.__dict__.pop(name, None)
         self.hidden_layers = [None]*self.n_hidden.size
 
         self.params = []
@@ -404,14 +592,15 @@ class LBN:
                                         stoch_activation_names=self.stoch_activation_names,
                                         m=self.m,
                                         det_W=None if layers_info is None else
-                                        np.array(
+                                        _weight_values(
                                         layers_info['hidden_layers'][i]['LBNlayer']['detLayer']\
-                                                                                            ['W']),
+                                                                                    ['W'], copy),
                                         det_b=None if layers_info is None else
-                                        np.array(layers_info['hidden_layers'][i]\
-                                                                    ['LBNlayer']['detLayer']['b']),
+                                        _weight_values(layers_info['hidden_layers'][i]\
+                                                            ['LBNlayer']['detLayer']['b'], copy),
                                         stoch_mlp_info=None if layers_info is None else
-                                        layers_info['hidden_layers'][i]['LBNlayer']['stochLayer'])
+                                        layers_info['hidden_layers'][i]['LBNlayer']['stochLayer'],
+                                        vectorized=self.vectorized, noise=self.noise, copy=copy)
             else:
                 self.hidden_layers[i] = LBNHiddenLayer(self.rng, self.trng,
                                         self.hidden_layers[i-1].output,
@@ -420,13 +609,14 @@ class LBN:
                                         det_activation_name=self.det_activation_names[i],
                                         stoch_activation_names=self.stoch_activation_names, 
                                         det_W=None if layers_info is None else
-                                        np.array(layers_info['hidden_layers'][i]['LBNlayer']\
-                                                                                ['detLayer']['W']),
+                                        _weight_values(layers_info['hidden_layers'][i]['LBNlayer']\
+                                                                        ['detLayer']['W'], copy),
                                         det_b=None if layers_info is None else
-                                        np.array(layers_info['hidden_layers'][i]['LBNlayer']\
-                                                                                ['detLayer']['b']),
+                                        _weight_values(layers_info['hidden_layers'][i]['LBNlayer']\
+                                                                        ['detLayer']['b'], copy),
                                         stoch_mlp_info=None if layers_info is None else
-                                        layers_info['hidden_layers'][i]['LBNlayer']['stochLayer'])
+                                        layers_info['hidden_layers'][i]['LBNlayer']['stochLayer'],
+                                        vectorized=self.vectorized, noise=self.noise, copy=copy)
 
             self.params.append(self.hidden_layers[i].params)
 
@@ -434,20 +624,100 @@ class LBN:
                                                             self.n_out, self.det_activation[-1],
                                                             self.det_activation_names[-1],
                                                             V_values=None 
-                                                            if layers_info is None else np.array(
-                                                            layers_info['output_layer']['W']))
+                                                    if layers_info is None else _weight_values(
+                                                    layers_info['output_layer']['W'], copy),
+                                                            vectorized=self.vectorized)
 
         self.params.append(self.output_layer.params)
         self.output = self.output_layer.output
         exp_value = -0.5*T.sum((self.output - self.y.dimshuffle('x',0,1))**2, axis=2)
-        max_exp_value = theano.ifelse.ifelse(T.lt(T.max(exp_value), -1*T.min(exp_value)),
-                                                                T.max(exp_value), T.min(exp_value))
- 
-        self.log_likelihood = T.sum(T.log(T.sum(T.exp(exp_value - max_exp_value), axis=0)) +
-                                                                                    max_exp_value)-\
+        #Log-sum-exp over the samples of each example, shifted by the maximum of the example so
+        #that examples with very different likelihoods do not underflow.
+        max_exp_value = T.max(exp_value, axis=0)
+        self.example_log_sum_exp = T.log(T.sum(T.exp(exp_value - max_exp_value), axis=0)) + \
+                                                                                    max_exp_value
+        self.log_likelihood = T.sum(self.example_log_sum_exp) - \
                                 self.y.shape[0]*(T.log(self.m)+self.y.shape[1]/2.*T.log(2*np.pi))
 
-        self.predict = theano.function(inputs=[self.x, self.m], outputs=self.output)
+        #Single pass approximation of the mean and variance of the output over the samples.
+        mean, variance = self.x, None
+        for i, layer in enumerate(self.hidden_layers):
+            mean, variance = layer.mean_field(mean, variance, self.det_activation_prime[i])
+        V = self.output_layer.W
+        a_mean = T.dot(mean, V.T)
+        self.mean_output = self.output_layer.activation(a_mean)
+        self.output_variance = self.det_activation_prime[-1](a_mean)**2*T.dot(variance, (V**2).T)
+
+    def compare_mean_field(self, x, m, m_chunk=None):
+        """
+        Measures the accuracy of predict_mean() and predict_moments() against the moments of m
+        samples drawn with predict() (see predict_summary()).
+
+        :returns: dict with the root mean squared differences 'mean_rmse' and 'variance_rmse', the
+                root mean squared standard error of the sampled mean 'sampled_standard_error' and
+                the times in seconds of the mean-field and sampled estimates.
+        """
+        #Both functions are compiled before being timed.
+        self.predict_moments(x[:1])
+        self.predict(x[:1], 1)
+        start = time.time()
+        mean, variance = self.predict_moments(x)
+        mean_field_time = time.time() - start
+        start = time.time()
+        sampled = self.predict_summary(x, m, m if m_chunk is None else m_chunk)
+        sampled_time = time.time() - start
+        rms = lambda a: float(np.sqrt(np.mean(a**2)))
+        return {'mean_rmse': rms(mean - sampled['mean']),
+                'variance_rmse': rms(variance - sampled['variance']),
+                'sampled_standard_error': rms(sampled['standard_error']),
+                'mean_field_time': mean_field_time, 'sampled_time': sampled_time}
+
+    def predict_summary(self, x, m, m_chunk, **kwargs):
+        """
+        Mean, variance and optionally quantiles and histograms of the predictive distribution,
+        estimated from m samples drawn with predict() in chunks of m_chunk samples. Only one chunk
+        is held in memory. See summary.predict_summary() for the options.
+        """
+        return summary.predict_summary(self.predict, x, m, m_chunk, **kwargs)
+
+    def seed(self, seed):
+        """
+        Resets the random streams of the network, so that predict() draws the same samples for
+        the same input after every call to seed(). This also affects the noise of training.
+
+        :type seed: int.
+        :param seed: seed of the random streams.
+        """
+        #The graph is built before seeding, RandomStreams.seed() only reseeds existing streams.
+        self.hidden_layers
+        self.trng.seed(seed)
+
+    def compile_function(self, name, settings=None, extra_shared=(), **kwargs):
+        """
+        Compiles a Theano function, reusing it from self.function_cache when possible.
+
+        :type name: string.
+        :param name: name of the function.
+
+        :type settings: dict.
+        :param settings: values embedded as constants in the graph of the function. Together with
+                        the architecture of the network they identify the function in the cache.
+
+        :type extra_shared: list of theano.SharedVariable.
+        :param extra_shared: shared variables used by the function besides the parameters and the
+                            random streams of the network, e.g. the training set.
+
+        :param kwargs: arguments of theano.function. Profiled functions are never cached.
+        """
+        if self.function_cache is None or kwargs.get('profile'):
+            return theano.function(**kwargs)
+        architecture = dict(self.network_properties(), vectorized=self.vectorized,
+                                                            noise=self.noise, sparse=self.sparse)
+        shared_variables = [p for layer in self.params for p in layer] + \
+                            [state for state, _ in self.trng.state_updates] + list(extra_shared)
+        return self.function_cache.function(
+                                self.function_cache.make_key(name, architecture, settings),
+                                shared_variables, lambda: theano.function(**kwargs))
 
     def fiting_variables(self, batch_size, train_set_x, train_set_y, test_set_x=None):
         """Sets useful variables for locating batches"""    
@@ -465,12 +735,12 @@ class LBN:
         # And weight the reported error by the batch_size when we average
         # Also, by keeping batch_start and batch_stop as symbolic variables,
         # we make the theano function easier to read
+        self.batch_size = batch_size
         self.batch_start = self.index * batch_size
         self.batch_stop = T.minimum(self.n_ex, (self.index + 1) * batch_size)
         self.effective_batch_size = self.batch_stop - self.batch_start
-
-        self.get_batch_size = theano.function(inputs=[self.index, self.n_ex],
-                                          outputs=self.effective_batch_size)
+        #get_batch_size is compiled again for the new batch size on first use.
+        self.__dict__.pop('get_batch_size', None)
 
         # compute number of minibatches for training
         # note that cases are the second dimension, not the first
@@ -481,10 +751,258 @@ class LBN:
             self.n_test_batches = int(np.ceil(1.0 * self.n_test / batch_size))
 
 
-    def fit(self, x, y, m, learning_rate, epochs, batch_size):
+    @staticmethod
+    def chunk_sizes(m, m_chunk):
+        """Splits m samples in chunks of at most m_chunk samples."""
+        return [m_chunk]*(m // m_chunk) + ([m % m_chunk] if m % m_chunk else [])
+
+    def get_log_likelihood_chunked(self, x, y, m, m_chunk):
+        """
+        Same estimate as get_log_likelihood(x, y, m) with the m samples drawn in chunks of m_chunk
+        samples. The log-sum-exp of each example is accumulated over the chunks, so the memory
+        used does not grow with m.
+
+        :type m_chunk: int.
+        :param m_chunk: maximum number of samples drawn at once.
+        """
+        log_sum_exp = None
+        for chunk in self.chunk_sizes(m, m_chunk):
+            chunk_log_sum_exp = self.get_example_log_sum_exp(x, y, chunk)
+            log_sum_exp = chunk_log_sum_exp if log_sum_exp is None else \
+                                                    np.logaddexp(log_sum_exp, chunk_log_sum_exp)
+        return np.sum(log_sum_exp) - y.shape[0]*(np.log(m) + y.shape[1]/2.*np.log(2*np.pi))
+
+    def estimator_variance(self, x, y, ms, repeats=20, m_chunk=None):
+        """
+        Diagnostic of the Monte Carlo log likelihood estimate: evaluates it repeats times for each
+        number of samples in ms and returns a list of dicts with the keys m, mean, variance and
+        samples_variance (variance times m, constant for i.i.d. noise). Comparing networks built
+        with different noise generators, e.g. with from_description(network_description(),
+        noise=...), shows the m each one needs for a given variance.
+
+        :type ms: list of ints.
+        :param ms: numbers of samples.
+
+        :type repeats: int.
+        :param repeats: number of estimates for each m.
+
+        :type m_chunk: int.
+        :param m_chunk: if set, the samples are drawn in chunks of at most m_chunk samples.
+        """
+        report = []
+        for m in ms:
+            if m_chunk is None:
+                estimates = [self.get_log_likelihood(x, y, m) for _ in xrange(repeats)]
+            else:
+                estimates = [self.get_log_likelihood_chunked(x, y, m, m_chunk)
+                                                                        for _ in xrange(repeats)]
+            variance = float(np.var(estimates, ddof=1))
+            report.append({'m': m, 'mean': float(np.mean(estimates)), 'variance': variance,
+                                                                    'samples_variance': variance*m})
+        return report
+
+    def compile_train_model(self, m, learning_rate, batch_size, n_train, train_set_x, train_set_y,
+                                    m_chunk=None, optimizer='sgd', lr_schedule=None, clip_norm=None,
+                                                                                profile=False):
         """
-        :type x: numpy.array.
-        :param x: input data of shape (n_samples, dimensionality).
+        Compiles the optimizer update on the minibatch [batch_start, batch_stop) of the shared
+        training set. The compiled function takes the minibatch index and the number of examples
+        in the shared set and returns the log likelihood of the minibatch. fiting_variables() must
+        be called first. The optimizer is kept in self.optimizer.
+
+        :type n_train: int.
+        :param n_train: total number of training examples. The gradient of the minibatch log
+                        likelihood is divided by it.
+
+        :type m_chunk: int.
+        :param m_chunk: if set, the m samples are drawn in chunks of at most m_chunk samples.
+
+        :type optimizer: string or optimizers.Optimizer.
+        :param optimizer: 'sgd', 'momentum', 'nesterov', 'rmsprop', 'adam' or an Optimizer
+                        instance, in which case learning_rate, lr_schedule and clip_norm are
+                        ignored.
+
+        :type lr_schedule: optimizers.StepDecay, ExponentialDecay or InverseTimeDecay.
+        :param lr_schedule: learning rate schedule over the number of updates.
+
+        :type clip_norm: float.
+        :param clip_norm: maximum global L2 norm of the gradients.
+
+        :type profile: bool.
+        :param profile: if True the compiled functions are profiled by Theano and their
+                        ProfileStats are kept in self.train_profiles.
+        """
+        self.optimizer = optimizers.get_optimizer(optimizer, learning_rate, lr_schedule, clip_norm)
+        if m_chunk is not None:
+            return self.compile_chunked_train_model(m, batch_size, n_train, train_set_x,
+                                                            train_set_y, m_chunk, profile=profile)
+        flat_params = [p for layer in self.params for p in layer]
+        gparams = [T.grad(-1./n_train*self.log_likelihood, p) for p in flat_params]
+
+        upd = self.optimizer.get_updates(flat_params, gparams)
+        settings = {'m': m, 'batch_size': batch_size, 'n_train': n_train}
+        settings.update(self.optimizer.settings())
+        train_model = self.compile_function('train_model',
+                                    settings=settings,
+                                    extra_shared=[train_set_x, train_set_y] + self.optimizer.state,
+                                    inputs=[self.index, self.n_ex],
+                                    outputs=self.log_likelihood,
+                                    updates=upd,
+                                    givens={self.x: train_set_x[self.batch_start:self.batch_stop],
+                                            self.y: train_set_y[self.batch_start:self.batch_stop],
+                                            self.m: T.constant(m, dtype=self.m.dtype)},
+                                    profile=profile)
+        self.train_profiles = [train_model.profile] if profile else []
+        return train_model
+
+    def compile_chunked_train_model(self, m, batch_size, n_train, train_set_x, train_set_y,
+                                                                        m_chunk, profile=False):
+        """
+        Memory bounded version of compile_train_model(), which sets self.optimizer. The exact
+        gradient of the log likelihood of the m samples is computed in two passes over chunks of
+        at most m_chunk samples. The first pass accumulates the log-sum-exp of each example. The
+        random streams are then reset and the second pass draws the same samples again and
+        accumulates the gradient of each chunk weighted by its share of the total. Returns a
+        python function with the same signature as the compiled train_model.
+        """
+        flat_params = [p for layer in self.params for p in layer]
+        givens = {self.x: train_set_x[self.batch_start:self.batch_stop],
+                  self.y: train_set_y[self.batch_start:self.batch_stop]}
+        total_log_sum_exp = T.vector('total_log_sum_exp', dtype=theano.config.floatX)
+        accumulators = [theano.shared(np.zeros_like(p.get_value(borrow=True)), borrow=True)
+                                                                            for p in flat_params]
+
+        #d/dp log(sum_chunks exp(lse_c)) = sum_chunks exp(lse_c - lse_total) * d/dp lse_c
+        weights = theano.gradient.disconnected_grad(T.exp(self.example_log_sum_exp -
+                                                                            total_log_sum_exp))
+        gparams = [T.grad(T.sum(weights*self.example_log_sum_exp), p) for p in flat_params]
+
+        chunk_log_sum_exp = self.compile_function('train_chunk_log_sum_exp',
+                                    settings={'batch_size': batch_size},
+                                    extra_shared=[train_set_x, train_set_y],
+                                    inputs=[self.index, self.n_ex, self.m],
+                                    outputs=self.example_log_sum_exp,
+                                    givens=givens,
+                                    profile=profile)
+        accumulate_gradient = self.compile_function('train_chunk_gradient',
+                                    settings={'batch_size': batch_size},
+                                    extra_shared=[train_set_x, train_set_y] + accumulators,
+                                    inputs=[self.index, self.n_ex, self.m, total_log_sum_exp],
+                                    updates=[(a, a + g) for a, g in zip(accumulators, gparams)],
+                                    givens=givens,
+                                    profile=profile)
+        #The accumulators hold the gradient of the log likelihood, the cost is its opposite.
+        upd = self.optimizer.get_updates(flat_params, [-1./n_train*a for a in accumulators])
+        settings = {'n_train': n_train}
+        settings.update(self.optimizer.settings())
+        apply_gradient = self.compile_function('train_apply_gradient',
+                                    settings=settings,
+                                    extra_shared=accumulators + self.optimizer.state,
+                                    inputs=[],
+                                    updates=upd + [(a, T.zeros_like(a)) for a in accumulators],
+                                    profile=profile)
+        self.train_profiles = [f.profile for f in (chunk_log_sum_exp, accumulate_gradient,
+                                                                apply_gradient)] if profile else []
+        chunks = self.chunk_sizes(m, m_chunk)
+
+        def train_model(minibatch_idx, n_ex):
+            random_states = [(s, s.get_value()) for s, _ in self.trng.state_updates]
+            log_sum_exp = None
+            for chunk in chunks:
+                lse = chunk_log_sum_exp(minibatch_idx, n_ex, chunk)
+                log_sum_exp = lse if log_sum_exp is None else np.logaddexp(log_sum_exp, lse)
+            for s, value in random_states:
+                s.set_value(value, borrow=True)
+            for chunk in chunks:
+                accumulate_gradient(minibatch_idx, n_ex, chunk, log_sum_exp)
+            apply_gradient()
+            return np.sum(log_sum_exp) - \
+                        log_sum_exp.shape[0]*(np.log(m) + self.n_out/2.*np.log(2*np.pi))
+        return train_model
+
+    def compile_eval_model(self, m, set_x, set_y, m_chunk=None):
+        """
+        Compiles the evaluation of the log likelihood on the shared set (set_x, set_y), which is
+        computed over the same minibatches as train_model and summed. Since the log-sum-exp is
+        taken per example, the sum is the log likelihood of the whole set while only one
+        minibatch is held in memory. fiting_variables() must be called first.
+
+        :type m_chunk: int.
+        :param m_chunk: if set, the m samples are drawn in chunks of at most m_chunk samples.
+
+        :returns: function (n_ex) -> log likelihood of the first n_ex examples of the set.
+        """
+        givens = {self.x: set_x[self.batch_start:self.batch_stop],
+                  self.y: set_y[self.batch_start:self.batch_stop]}
+        batch_size = self.batch_size
+        if m_chunk is None:
+            eval_model = self.compile_function('eval_model',
+                                    settings={'m': m, 'batch_size': batch_size},
+                                    extra_shared=[set_x, set_y],
+                                    inputs=[self.index, self.n_ex],
+                                    outputs=self.log_likelihood,
+                                    givens=dict(givens, **{self.m: T.constant(m,
+                                                                        dtype=self.m.dtype)}))
+
+            def evaluate(n_ex):
+                return sum(eval_model(minibatch_idx, n_ex) for minibatch_idx in
+                                                xrange(int(np.ceil(1.0 * n_ex / batch_size))))
+            return evaluate
+
+        chunk_log_sum_exp = self.compile_function('eval_chunk_log_sum_exp',
+                                    settings={'batch_size': batch_size},
+                                    extra_shared=[set_x, set_y],
+                                    inputs=[self.index, self.n_ex, self.m],
+                                    outputs=self.example_log_sum_exp,
+                                    givens=givens)
+        chunks = self.chunk_sizes(m, m_chunk)
+
+        def evaluate(n_ex):
+            log_likelihood = 0.
+            for minibatch_idx in xrange(int(np.ceil(1.0 * n_ex / batch_size))):
+                log_sum_exp = None
+                for chunk in chunks:
+                    lse = chunk_log_sum_exp(minibatch_idx, n_ex, chunk)
+                    log_sum_exp = lse if log_sum_exp is None else np.logaddexp(log_sum_exp, lse)
+                log_likelihood += np.sum(log_sum_exp)
+            return log_likelihood - n_ex*(np.log(m) + self.n_out/2.*np.log(2*np.pi))
+        return evaluate
+
+    def _shared_x(self, x):
+        """
+        Returns the input data x as a shared variable, a sparse CSR one if self.sparse. Data that
+        already has the floatX dtype is not copied, e.g. the shared memory of a sweep, since the
+        compiled functions never write to it.
+        """
+        if self.sparse:
+            return theano.shared(scipy.sparse.csr_matrix(x, dtype=theano.config.floatX),
+                                                                                    borrow=True)
+        return theano.shared(np.asarray(x, dtype=theano.config.floatX), borrow=True)
+
+    def _eval_set(self, x, y, eval_subsample, rows=None):
+        """
+        Returns (x, y), or a fixed random subsample of eval_subsample of its rows drawn with
+        self.rng, as shared variables, and the rows of the subsample. If rows is given it is used
+        as the subsample.
+        """
+        if rows is None and eval_subsample is not None and eval_subsample < x.shape[0]:
+            rows = np.sort(self.rng.choice(x.shape[0], eval_subsample, replace=False))
+        if rows is not None:
+            x, y = x[rows], y[rows]
+        return self._shared_x(x), theano.shared(np.asarray(y, dtype=theano.config.floatX),
+                                                                            borrow=True), rows
+
+    def fit(self, x, y, m, learning_rate, epochs, batch_size, m_chunk=None, optimizer='sgd',
+                                    lr_schedule=None, clip_norm=None, callbacks=None,
+                                    metrics_log=None, plot=False, save_fname="last_network.json",
+                                    profile=False, validation=None, eval_every=1,
+                                    eval_subsample=None, patience=None, min_delta=0.,
+                                    restore_best=False, checkpoint_dir=None,
+                                    checkpoint_every=None, resume=False):
+        """
+        :type x: numpy.array or scipy.sparse matrix.
+        :param x: input data of shape (n_samples, dimensionality). Sparse if the network was built
+                with sparse=True.
 
         :type y: numpy.array.
         :param y: output data of shape (n_samples, 1).
@@ -500,102 +1018,543 @@ class LBN:
 
         :type batch_size: int
         :param batch_size: minibatch size for the SGD update.
-        """
 
-        train_set_x = theano.shared(np.asarray(x,
-                                            dtype=theano.config.floatX))
+        :type m_chunk: int.
+        :param m_chunk: if set, the m samples are drawn in chunks of at most m_chunk samples
+                        both in training and in the evaluation of the log likelihood, so that the
+                        memory used does not grow with m.
+
+        :type optimizer: string or optimizers.Optimizer.
+        :param optimizer: 'sgd', 'momentum', 'nesterov', 'rmsprop', 'adam' or an Optimizer
+                        instance, see compile_train_model().
+
+        :type lr_schedule: optimizers.StepDecay, ExponentialDecay or InverseTimeDecay.
+        :param lr_schedule: learning rate schedule over the number of updates.
+
+        :type clip_norm: float.
+        :param clip_norm: maximum global L2 norm of the gradients.
+
+        :type callbacks: list of telemetry.Callback.
+        :param callbacks: objects notified at the beginning and end of training and at the end of
+                        each minibatch and epoch.
+
+        :type metrics_log: string.
+        :param metrics_log: if set, the metrics of each epoch are appended to this JSONL file.
+
+        :type plot: bool or string.
+        :param plot: if True the log likelihood is plotted at the end without blocking. If a
+                    string, the plot is saved to that file.
+
+        :type save_fname: string.
+        :param save_fname: file where the network is saved at the end. None to not save it.
+
+        :type profile: bool.
+        :param profile: if True the training functions are profiled by Theano and the profile is
+                        printed at the end.
+
+        :type validation: tuple of numpy.array.
+        :param validation: (x, y) held-out set on which the log likelihood is evaluated instead of
+                        the training set.
+
+        :type eval_every: int.
+        :param eval_every: the log likelihood is evaluated every eval_every epochs and after the
+                        last one. In the other epochs only the sum of the minibatch log
+                        likelihoods computed during training is reported.
+
+        :type eval_subsample: int.
+        :param eval_subsample: if set, the log likelihood is evaluated on a fixed random subsample
+                        of this many examples of the evaluation set.
+
+        :type patience: int.
+        :param patience: if set, training stops when the evaluated log likelihood has not improved
+                        by more than min_delta for this many evaluations.
+
+        :type min_delta: float.
+        :param min_delta: minimum increase of the log likelihood counted as an improvement.
+
+        :type restore_best: bool.
+        :param restore_best: if True, a copy of the parameters is kept in memory each time the
+                        evaluated log likelihood improves and the best ones are restored at the
+                        end of training.
+
+        :type checkpoint_dir: string.
+        :param checkpoint_dir: if set, a checkpoint with the weights, optimizer state, random
+                        number generators and progress is saved there at the end of each epoch
+                        (see save_checkpoint()).
+
+        :type checkpoint_every: int.
+        :param checkpoint_every: if set, a checkpoint is also saved every checkpoint_every
+                        minibatches.
+
+        :type resume: bool or string.
+        :param resume: if True, training resumes from the checkpoint in checkpoint_dir when there
+                    is one. If a string, it is the checkpoint to resume from and must exist.
+                    The other arguments must be the same as in the interrupted call; the result
+                    is then the same as if training had not been interrupted.
+
+        :returns: list with the metrics of each epoch, see telemetry.Telemetry.epoch_end(). The
+                log likelihood of the epochs without evaluation is None and the sum of the
+                minibatch log likelihoods is in 'train_log_likelihood'. The best evaluated log
+                likelihood and its epoch are kept in self.best_log_likelihood and
+                self.best_epoch.
+        """
+        monitor = telemetry.Telemetry(callbacks, metrics_log, plot)
+        train_set_x = self._shared_x(x)
 
         train_set_y = theano.shared(np.asarray(y,
-                                            dtype=theano.config.floatX))
+                                            dtype=theano.config.floatX), borrow=True)
 
 
         self.fiting_variables(batch_size, train_set_x, train_set_y)
-
+        self._check_memory(batch_size, m, m_chunk, optimizer, x.shape[0])
+        resume_from = checkpoint_dir if resume is True else resume
+        if resume_from and resume is not True and not checkpoint.is_binary_checkpoint(resume_from):
+            raise ValueError, "Cannot resume from {0!r}, it is not a checkpoint.".format(
+                                                                                    resume_from)
+        if resume_from and checkpoint.is_binary_checkpoint(resume_from):
+            state = self.load_checkpoint(resume_from)
+            assert state['n_train'] == self.n_train and state['batch_size'] == batch_size, \
+                    "The checkpoint was saved with a different training set or batch size."
+            print "Resuming from epoch {0}, minibatch {1}".format(state['epoch'],
+                                                                            state['minibatch'])
+        else:
+            state = {'epoch': 1, 'minibatch': 0, 'train_log_likelihood': 0.,
+                     'best_log_likelihood': None, 'best_epoch': None, 'bad_evaluations': 0,
+                     'best_params': None, 'eval_rows': None, 'history': [],
+                     'n_train': self.n_train, 'batch_size': batch_size}
+        with monitor.timer('compile'):
+            self.train_model = self.compile_train_model(m, learning_rate, batch_size, x.shape[0],
+                                    train_set_x, train_set_y, m_chunk=m_chunk, optimizer=optimizer,
+                                    lr_schedule=lr_schedule, clip_norm=clip_norm, profile=profile)
+
+            #The training set already on the device is evaluated in place.
+            if validation is None and (eval_subsample is None or eval_subsample >= x.shape[0]):
+                eval_set_x, eval_set_y = train_set_x, train_set_y
+            else:
+                eval_x, eval_y = (x, y) if validation is None else validation
+                eval_set_x, eval_set_y, state['eval_rows'] = self._eval_set(eval_x, eval_y,
+                                                            eval_subsample, state['eval_rows'])
+            n_eval = eval_set_x.get_value(borrow=True).shape[0]
+            evaluate = self.compile_eval_model(m, eval_set_x, eval_set_y, m_chunk=m_chunk)
+        if 'optimizer' in state:
+            self.optimizer.set_state(state.pop('optimizer'))
         flat_params = [p for layer in self.params for p in layer]
-        gparams = [T.grad(-1./x.shape[0]*self.log_likelihood, p) for p in flat_params]
+        monitor.history = list(state['history'])
+        monitor.train_begin(m=m, batch_size=batch_size, epochs=epochs, n_train=self.n_train,
+                            m_chunk=m_chunk, optimizer=self.optimizer.settings(),
+                            eval_set='train' if validation is None else 'validation',
+                            n_eval=n_eval, start_epoch=state['epoch'],
+                            start_minibatch=state['minibatch'])
+        stop = False
+        for e in xrange(state['epoch'], epochs+1):
+            with monitor.timer('train'):
+                for minibatch_idx in xrange(state['minibatch'], self.n_train_batches):
+                    minibatch_likelihood = self.train_model(minibatch_idx, self.n_train)
+                    state['train_log_likelihood'] += float(minibatch_likelihood)
+                    monitor.batch_end(e, minibatch_idx, minibatch_likelihood,
+                                    min(batch_size, self.n_train - minibatch_idx*batch_size))
+                    if checkpoint_dir is not None and checkpoint_every is not None and \
+                            (minibatch_idx + 1) % checkpoint_every == 0 and \
+                            minibatch_idx + 1 < self.n_train_batches:
+                        state.update(epoch=e, minibatch=minibatch_idx + 1,
+                                                                history=monitor.history)
+                        self.save_checkpoint(checkpoint_dir, state)
+            train_likelihood = state['train_log_likelihood']
+            epoch_likelihood = None
+            if e % eval_every == 0 or e == epochs:
+                with monitor.timer('eval'):
+                    epoch_likelihood = evaluate(n_eval)
+                print "Epoch {0} log likelihood: {1}".format(e, epoch_likelihood)
+                if state['best_log_likelihood'] is None or \
+                                epoch_likelihood > state['best_log_likelihood'] + min_delta:
+                    state.update(best_log_likelihood=float(epoch_likelihood), best_epoch=e,
+                                                                            bad_evaluations=0)
+                    if restore_best:
+                        state['best_params'] = [p.get_value() for p in flat_params]
+                else:
+                    state['bad_evaluations'] += 1
+                    stop = patience is not None and state['bad_evaluations'] >= patience
+            else:
+                print "Epoch {0} minibatch log likelihood: {1}".format(e, train_likelihood)
+            monitor.epoch_end(e, epoch_likelihood, self.n_train,
+                                                        train_log_likelihood=train_likelihood)
+            state.update(epoch=e + 1, minibatch=0, train_log_likelihood=0.,
+                                                                    history=monitor.history)
+            if checkpoint_dir is not None:
+                self.save_checkpoint(checkpoint_dir, state)
+            if stop:
+                print "Early stopping at epoch {0}, best log likelihood {1} at epoch {2}".format(
+                                            e, state['best_log_likelihood'], state['best_epoch'])
+                break
+        self.best_log_likelihood = state['best_log_likelihood']
+        self.best_epoch = state['best_epoch']
+        if restore_best and state['best_params'] is not None:
+            for p, value in zip(flat_params, state['best_params']):
+                p.set_value(value)
+        if save_fname is not None:
+            self.save_network(save_fname)
+        if profile:
+            for p in self.train_profiles:
+                p.summary(file=sys.stdout)
+        return monitor.train_end()
+
+    def _check_memory(self, batch_size, m, m_chunk, optimizer, n_train):
+        """Warns if the estimated memory of training exceeds the memory of the machine."""
+        available = planner.available_memory()
+        optimizer = optimizer if isinstance(optimizer, str) else None
+        needed = self.estimate_memory(batch_size, m, m_chunk, 'train', optimizer, n_train)['total']
+        if available is not None and needed > available:
+            warnings.warn("Training is estimated to need {0} bytes but the machine has {1}. See "
+                        "tune_memory() for a batch_size and m_chunk that fit.".format(needed,
+                                                                                    available))
+
+    def partial_fit(self, x, y, m, learning_rate, steps=1, n_train=None, optimizer='sgd',
+                                                            lr_schedule=None, clip_norm=None):
+        """
+        Updates the network with a batch of new examples, e.g. as they arrive from a stream. The
+        update function is compiled on the first call and reused while the settings do not
+        change, and the optimizer state (momentum, moment estimates, iteration of the learning
+        rate schedule) is kept between calls together with it. It is separate from
+        self.optimizer, which belongs to fit(). Nothing is saved or plotted.
+
+        :type x: numpy.array or scipy.sparse matrix.
+        :param x: input data of shape (n_examples, n_in), or a single example of shape (n_in,).
+                Sparse if the network was built with sparse=True.
+
+        :type y: numpy.array.
+        :param y: output data of shape (n_examples, n_out), or (n_out,).
+
+        :type steps: int.
+        :param steps: number of optimizer updates applied on the batch.
+
+        :type n_train: int.
+        :param n_train: if set, the gradient of the batch log likelihood is divided by n_train as
+                        in fit(). Otherwise it is divided by the number of examples of the batch.
 
-        upd = [(param, param - learning_rate * gparam)
-                for param, gparam in zip(flat_params, gparams)]
-        self.train_model = theano.function(inputs=[self.index, self.n_ex],
+        :param m, learning_rate, optimizer, lr_schedule, clip_norm: see fit().
+
+        :returns: log likelihood of the batch computed in the last step, before its update.
+        """
+        assert steps >= 1, "steps must be at least 1: {0!r}".format(steps)
+        if self.sparse:
+            x = scipy.sparse.csr_matrix(x, dtype=theano.config.floatX)
+        else:
+            x = np.atleast_2d(np.asarray(x, dtype=theano.config.floatX))
+        y = np.atleast_2d(np.asarray(y, dtype=theano.config.floatX))
+        config = (m, learning_rate, n_train, optimizer, lr_schedule, clip_norm)
+        #(config, optimizer, compiled update) of the last call.
+        if self.__dict__.get('_partial_fit', (None,))[0] != config:
+            optimizer = optimizers.get_optimizer(optimizer, learning_rate, lr_schedule, clip_norm)
+            flat_params = [p for layer in self.params for p in layer]
+            scale = 1./n_train if n_train is not None else 1./self.x.shape[0]
+            gparams = [T.grad(-scale*self.log_likelihood, p) for p in flat_params]
+            upd = optimizer.get_updates(flat_params, gparams)
+            settings = {'m': m, 'n_train': n_train}
+            settings.update(optimizer.settings())
+            self._partial_fit = (config, optimizer, self.compile_function('partial_fit_model',
+                                    settings=settings,
+                                    extra_shared=optimizer.state,
+                                    inputs=[self.x, self.y],
                                     outputs=self.log_likelihood,
                                     updates=upd,
-                                    givens={self.x: train_set_x[self.batch_start:self.batch_stop],
-                                            self.y: train_set_y[self.batch_start:self.batch_stop],
-                                            self.m: m})
+                                    givens={self.m: T.constant(m, dtype=self.m.dtype)}))
+        partial_fit_model = self._partial_fit[2]
+        for _ in xrange(steps):
+            log_likelihood = partial_fit_model(x, y)
+        return log_likelihood
+
+    def fit_stream(self, data, m, learning_rate, epochs, batch_size, chunk_size, n_train=None,
+                            m_chunk=None, optimizer='sgd', lr_schedule=None, clip_norm=None,
+                            callbacks=None, metrics_log=None, plot=False,
+                            save_fname="last_network.json", profile=False, validation=None,
+                            eval_every=1, eval_subsample=None):
+        """
+        Same training as fit() for datasets that do not fit in memory. Data is consumed in chunks
+        of chunk_size rows that are read by a background thread while the previous chunk trains,
+        and swapped into fixed-size shared buffers. The log likelihood reported for each epoch is
+        the sum of the minibatch log likelihoods computed during the epoch.
+
+        :type data: tuple, function or iterator.
+        :param data: (x, y) pair of arrays, e.g. numpy.memmap, or function without arguments
+                    returning an iterator of (x, y) chunks of at most chunk_size rows. The
+                    function is called once per epoch. An iterator of chunks, e.g. a generator,
+                    can only be consumed once, so it is only accepted when epochs is 1.
+
+        :type m: int.
+        :param m: number of samples drawn from the network.
+
+        :type learning_rate: float.
+        :param learning_rate: step size for the stochastic gradient descent learning algoriithm.
+
+        :type epochs: int.
+        :param epochs: number of training epochs.
 
-        self.get_log_likelihood = theano.function(inputs=[self.x, self.y, self.m],
-                                                outputs=self.log_likelihood)
-        log_likelihood = []
+        :type batch_size: int
+        :param batch_size: minibatch size for the SGD update.
+
+        :type chunk_size: int.
+        :param chunk_size: number of examples held in memory at once.
+
+        :type n_train: int.
+        :param n_train: total number of training examples, used to scale the gradient as in fit().
+                        Required when data is a function or an iterator.
+
+        :type m_chunk: int.
+        :param m_chunk: if set, the m samples are drawn in chunks of at most m_chunk samples.
+
+        :param optimizer, lr_schedule, clip_norm, callbacks, metrics_log, plot, save_fname,
+                profile: see fit(). The train time of an epoch includes waiting for the chunks.
+
+        :type validation: tuple of numpy.array.
+        :param validation: (x, y) held-out set, small enough to fit in memory, evaluated every
+                        eval_every epochs and after the last one. Without it the log likelihood of
+                        an epoch is the sum of its minibatch log likelihoods.
+
+        :type eval_subsample: int.
+        :param eval_subsample: if set, only a fixed random subsample of this many examples of the
+                        validation set is evaluated.
+
+        :returns: list with the metrics of each epoch, see telemetry.Telemetry.epoch_end().
+        """
+        assert not self.sparse, "fit_stream() does not support sparse inputs."
+        monitor = telemetry.Telemetry(callbacks, metrics_log, plot)
+        if callable(data):
+            assert n_train is not None, "n_train is required when data is a function."
+            get_chunks = data
+        elif hasattr(data, 'next'):
+            if epochs != 1:
+                raise ValueError, "An iterator of chunks can only be read once, pass a function " \
+                                "returning a new iterator to train for {0} epochs.".format(epochs)
+            assert n_train is not None, "n_train is required when data is an iterator."
+            get_chunks = lambda: data
+        else:
+            x, y = data
+            n_train = x.shape[0] if n_train is None else n_train
+            get_chunks = lambda: streaming.array_chunks(x, y, chunk_size)
+
+        train_set_x = theano.shared(np.zeros((chunk_size, self.n_in), dtype=theano.config.floatX),
+                                                                                    borrow=True)
+        train_set_y = theano.shared(np.zeros((chunk_size, self.n_out),
+                                                    dtype=theano.config.floatX), borrow=True)
+        self.fiting_variables(batch_size, train_set_x, train_set_y)
+        with monitor.timer('compile'):
+            self.train_model = self.compile_train_model(m, learning_rate, batch_size, n_train,
+                                    train_set_x, train_set_y, m_chunk=m_chunk, optimizer=optimizer,
+                                    lr_schedule=lr_schedule, clip_norm=clip_norm, profile=profile)
+            if validation is not None:
+                eval_set_x, eval_set_y, _ = self._eval_set(validation[0], validation[1],
+                                                                                eval_subsample)
+                n_eval = eval_set_x.get_value(borrow=True).shape[0]
+                evaluate = self.compile_eval_model(m, eval_set_x, eval_set_y, m_chunk=m_chunk)
+        monitor.train_begin(m=m, batch_size=batch_size, epochs=epochs, n_train=n_train,
+                            m_chunk=m_chunk, chunk_size=chunk_size,
+                            optimizer=self.optimizer.settings(),
+                            eval_set='minibatches' if validation is None else 'validation')
         for e in xrange(1,epochs+1):
-            for minibatch_idx in xrange(self.n_train_batches):
-                minibatch_likelihood = self.train_model(minibatch_idx, self.n_train)
-            log_likelihood.append(self.get_log_likelihood(x,y,m))
-            print "Epoch {0} log likelihood: {1}".format(e, log_likelihood[-1])
-        self.save_network("last_network.json")
+            epoch_likelihood = 0.
+            n_examples = 0
+            batch = 0
+            with monitor.timer('train'):
+                for x_chunk, y_chunk, n_rows in streaming.ChunkPrefetcher(get_chunks(),
+                                    chunk_size, self.n_in, self.n_out, theano.config.floatX):
+                    train_set_x.set_value(x_chunk, borrow=True)
+                    train_set_y.set_value(y_chunk, borrow=True)
+                    for minibatch_idx in xrange(int(np.ceil(1.0 * n_rows / batch_size))):
+                        minibatch_likelihood = self.train_model(minibatch_idx, n_rows)
+                        epoch_likelihood += minibatch_likelihood
+                        monitor.batch_end(e, batch, minibatch_likelihood,
+                                                min(batch_size, n_rows - minibatch_idx*batch_size))
+                        batch += 1
+                    n_examples += n_rows
+            log_likelihood = epoch_likelihood
+            if validation is not None:
+                log_likelihood = None
+                if e % eval_every == 0 or e == epochs:
+                    with monitor.timer('eval'):
+                        log_likelihood = evaluate(n_eval)
+            if log_likelihood is None:
+                print "Epoch {0} minibatch log likelihood: {1}".format(e, epoch_likelihood)
+            else:
+                print "Epoch {0} log likelihood: {1}".format(e, log_likelihood)
+            monitor.epoch_end(e, log_likelihood, n_examples, train_log_likelihood=epoch_likelihood)
+        if save_fname is not None:
+            self.save_network(save_fname)
+        if profile:
+            for p in self.train_profiles:
+                p.summary(file=sys.stdout)
+        return monitor.train_end()
+
+    def fit_parallel(self, x, y, m, learning_rate, epochs, batch_size, n_workers, mode='sync',
+                                                    seed=1234, cache_dir=None, baseline_time=None):
+        """
+        Data-parallel version of fit() with n_workers processes, each training on a shard of the
+        data. Returns the per-epoch log likelihood, timings, and speedup and scaling efficiency
+        against a single-process epoch. See parallel.fit_parallel() for the arguments.
+        """
+        assert not self.sparse, "fit_parallel() does not support sparse inputs."
+        return parallel.fit_parallel(self, x, y, m, learning_rate, epochs, batch_size, n_workers,
+                                            mode=mode, seed=seed, cache_dir=cache_dir,
+                                            baseline_time=baseline_time)
 
-        plt.plot(np.arange(epochs),np.array(log_likelihood))
-        plt.show()
+    def estimate_memory(self, batch_size, m, m_chunk=None, mode='train', optimizer='sgd',
+                                                                                n_train=None):
+        """
+        Estimates the peak memory in bytes of training ('train'), evaluating ('eval') or
+        predicting ('predict') with batch_size examples and m samples drawn in chunks of m_chunk,
+        without compiling anything. See planner.estimate().
+        """
+        return planner.estimate(self.network_properties(), batch_size, m, m_chunk, mode,
+                                optimizer, n_train, np.dtype(theano.config.floatX).itemsize,
+                                self.noise)
 
-    def save_network(self, fname):
+    def tune_memory(self, budget, m, mode='train', max_batch_size=None, optimizer='sgd',
+                                                                                n_train=None):
         """
-        Saves network to json file.
+        Returns the batch_size and m_chunk with the highest throughput whose estimated memory
+        fits in budget bytes, and their estimate. See planner.tune().
+        """
+        return planner.tune(self.network_properties(), budget, m, mode, max_batch_size,
+                            optimizer, n_train, np.dtype(theano.config.floatX).itemsize,
+                            self.noise)
+
+    def network_properties(self):
+        """
+        Returns the properties that define the architecture of the network as a dict.
+        """
+        return {"n_in": self.n_in, "n_hidden": self.n_hidden.tolist(), "n_out": self.n_out,
+                "det_activations": self.det_activation_names,
+                "stoch_activations": self.stoch_activation_names,
+                "stoch_n_hidden": [sh.tolist() for sh in self.stoch_n_hidden]}
+
+    def network_description(self):
+        """
+        Returns the network properties and the weights of all the layers as a dict. Weights are
+        numpy arrays.
+        """
+        def det_layer_description(det):
+            return {"n_in": det.n_in, "n_out": det.n_out, "activation": det.activation_name,
+                    "W": det.W.get_value(),
+                    "b": det.b.get_value() if det.no_bias is False else None,
+                    "no_bias": det.no_bias}
+
+        hidden_layers = [{"LBNlayer": {"detLayer": det_layer_description(l.det_layer),
+                                        "stochLayer": [{"detLayer": det_layer_description(hs)}
+                                                            for hs in l.stoch_layer.hidden_layers]}}
+                                                                    for l in self.hidden_layers]
+        return {"network_properties": self.network_properties(),
+                "layers": {"hidden_layers": hidden_layers,
+                            "output_layer": {"n_in": self.output_layer.n_in,
+                                            "n_out": self.output_layer.n_out,
+                                            "activation": self.output_layer.activation_name,
+                                            "W": self.output_layer.W.get_value()}}}
+
+    def set_weights(self, layers):
+        """
+        Sets the weights of the network, which must be defined, from a dict with the layout of
+        network_description()['layers'].
+        """
+        def set_det_layer(det, info):
+            det.W.set_value(np.asarray(info['W'], dtype=theano.config.floatX))
+            if det.no_bias is False:
+                det.b.set_value(np.asarray(info['b'], dtype=theano.config.floatX))
+
+        for l, info in zip(self.hidden_layers, layers['hidden_layers']):
+            set_det_layer(l.det_layer, info['LBNlayer']['detLayer'])
+            for hs, hs_info in zip(l.stoch_layer.hidden_layers, info['LBNlayer']['stochLayer']):
+                set_det_layer(hs, hs_info['detLayer'])
+        self.output_layer.W.set_value(np.asarray(layers['output_layer']['W'],
+                                                                    dtype=theano.config.floatX))
+
+    def save_checkpoint(self, dirname, training_state):
+        """
+        Saves a binary checkpoint (see save_network()) with the weights, the optimizer state, the
+        state of self.rng and of the random streams of self.trng and the given training state.
+        The checkpoint is replaced atomically and can also be loaded with init_from_file().
+
+        :type training_state: dict.
+        :param training_state: progress of the training loop, e.g. epoch and minibatch index.
+        """
+        network_description = self.network_description()
+        network_description['training_state'] = dict(training_state,
+                        optimizer=self.optimizer.get_state() if hasattr(self, 'optimizer') else [],
+                        rng=checkpoint.random_state_description(self.rng),
+                        trng=[checkpoint.random_state_description(s.get_value(borrow=True))
+                                                            for s, _ in self.trng.state_updates])
+        checkpoint.save_binary(network_description, dirname, atomic=True)
+
+    def load_checkpoint(self, dirname):
+        """
+        Restores the weights and the random number generators saved by save_checkpoint() and
+        returns the training state. The optimizer state is in training_state['optimizer'] and is
+        restored with self.optimizer.set_state() once the training functions are compiled.
+        """
+        network_description = checkpoint.load(dirname)
+        self.set_weights(network_description['layers'])
+        training_state = network_description['training_state']
+        checkpoint.set_random_state(self.rng, training_state['rng'])
+        for (s, _), state in zip(self.trng.state_updates, training_state['trng']):
+            random_state = np.random.RandomState()
+            checkpoint.set_random_state(random_state, state)
+            s.set_value(random_state, borrow=True)
+        return training_state
+
+    def save_network(self, fname, binary=False):
+        """
+        Saves network to json file or to a binary checkpoint.
 
         :type fname: string.
-        :param fname: file name (with local or global path) where to store the network.
-        """
-        output_string = "{\"network_properties\":"
-
-        output_string += json.dumps({"n_in":self.n_in, "n_hidden":self.n_hidden.tolist(), "n_out":self.n_out,
-                "det_activations":self.det_activation_names,
-                "stoch_activations":self.stoch_activation_names, "stoch_n_hidden":[sh.tolist() for sh in self.stoch_n_hidden]})
-        output_string += ",\"layers\":{\"hidden_layers\":["
-        for k, l in enumerate(self.hidden_layers):
-            det = l.det_layer
-            stoch = l.stoch_layer
-            if k > 0:
-                output_string += ","
-            output_string += "{\"LBNlayer\":{\"detLayer\":"
-            output_string += json.dumps({"n_in":det.n_in,"n_out":det.n_out,
-                    "activation":det.activation_name, "W":det.W.get_value().tolist(),
-                    "b":det.b.get_value().tolist()if det.no_bias is False else None, "no_bias":det.no_bias})
-            output_string += ", \"stochLayer\":"
-            output_string += "["
-            for i, hs in enumerate(stoch.hidden_layers):
-                if i > 0:
-                    output_string += ","
-                output_string += "{\"detLayer\":"
-                output_string += json.dumps({"n_in":hs.n_in, "n_out": hs.n_out,
-                                    "activation":hs.activation_name, "W":hs.W.get_value().tolist(),
-                                    "b": hs.b.get_value().tolist() if hs.no_bias is False else None,
-                                    "no_bias": hs.no_bias})
-                output_string += "}"
-            output_string += "]}}"
-        output_string += "]"
-        output_string += ",\"output_layer\":"
-        output_string += json.dumps({"n_in": self.output_layer.n_in,
-                                    "n_out":self.output_layer.n_out,
-                                    "activation":self.output_layer.activation_name,
-                                    "W":self.output_layer.W.get_value().tolist()})
-        output_string += "}}"
-        with open('{0}'.format(fname), 'w') as f:
-            f.write(output_string)
+        :param fname: file name (with local or global path) where to store the network. If
+                    binary is True, it is a directory.
+
+        :type binary: bool.
+        :param binary: if True the weights are stored as raw .npy arrays together with a json
+                    manifest (see checkpoint.py). These files are smaller, faster to read and
+                    write and can be memory-mapped by init_from_file().
+        """
+        if binary:
+            checkpoint.save_binary(self.network_description(), fname)
+        else:
+            checkpoint.save_json(self.network_description(), fname)
 
     @classmethod
-    def init_from_file(cls, fname):
+    def init_from_file(cls, fname, mmap=False, **kwargs):
         """
         Loads a saved network from file fname.
         :type fname: string.
-        :param fname: file name (with local or global path) from where to load the network.
+        :param fname: json file or binary checkpoint directory (with local or global path) from
+                    where to load the network.
+
+        :type mmap: bool.
+        :param mmap: if True the weights of a binary checkpoint are memory-mapped and used by the
+                    shared variables without copying them. Every load maps the files
+                    copy-on-write, so training the network changes neither the files nor other
+                    networks loaded from them.
+
+        :param kwargs: extra keyword arguments passed to the constructor, e.g. vectorized.
+        """
+        return cls.from_description(checkpoint.load(fname, mmap=mmap), copy=not mmap, **kwargs)
+
+    @classmethod
+    def from_description(cls, network_description, copy=True, **kwargs):
         """
-        with open(fname) as f:
-            network_description = json.load(f)
+        Builds a network from a dict as returned by network_description() or checkpoint.load().
+
+        :type copy: bool.
+        :param copy: if True the network copies the weights of the description. If False it uses
+                    the arrays of the description, so that networks built from the same
+                    description share their weights.
 
+        :param kwargs: extra keyword arguments passed to the constructor, e.g. vectorized.
+
+        The graph is built with the given weights when it is first used.
+        """
         network_properties= network_description['network_properties']
         loaded_lbn = cls(network_properties['n_in'], network_properties['n_hidden'],
                         network_properties['n_out'], network_properties['det_activations'],
                         network_properties['stoch_activations'],
-                        network_properties['stoch_n_hidden'], keep_undefined=True)
+                        network_properties['stoch_n_hidden'], keep_undefined=True, **kwargs)
 
-        loaded_lbn.define_network(network_description['layers'])
+        loaded_lbn._pending_layers = network_description['layers']
+        loaded_lbn._pending_copy = copy
         return loaded_lbn
 
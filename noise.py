@@ -0,0 +1,89 @@
+"""
+Uniform noise of the Bernoulli units of the LBN stochastic layers. A unit is on in a sample when
+its uniform draw is lower than its probability, so the uniforms of the m samples of a unit decide
+how well the m samples cover its two states. Besides plain i.i.d. draws, the generators below
+spread the m draws of each unit more evenly over [0, 1), which lowers the variance of the Monte
+Carlo estimates (log likelihood, gradients, predictive moments) for the same m.
+
+In all generators each sample taken alone is distributed as with i.i.d. noise: its uniforms are
+independent across units and examples. Only the draws of a unit across the m samples are
+correlated, so the estimates stay unbiased.
+
+Generators:
+    - 'iid': independent uniforms.
+    - 'stratified': Latin hypercube along the m axis. [0, 1) is split in m strata and every unit
+      gets one draw in each stratum. The strata are assigned to the samples by a random
+      permutation per unit.
+    - 'antithetic': the second half of the samples uses 1 - u of the first half.
+    - 'halton': randomized quasi-Monte Carlo. Sample j of a layer uses point j of a Halton
+      sequence with one dimension per unit, with digits scrambled by a fixed linear permutation
+      and a random shift per example and unit (Cranley-Patterson rotation).
+
+When the m samples are drawn in chunks (m_chunk), the draws are spread within each chunk.
+"""
+import numpy as np
+import theano
+import theano.tensor as T
+
+NOISE = ('iid', 'stratified', 'antithetic', 'halton')
+#Digits of the Halton points. Sample indices are taken modulo 2**HALTON_DIGITS in base 2.
+HALTON_DIGITS = 20
+
+
+def primes(n):
+    """Returns the first n prime numbers."""
+    found = []
+    candidate = 2
+    while len(found) < n:
+        if all(candidate % p for p in found if p*p <= candidate):
+            found.append(candidate)
+        candidate += 1
+    return found
+
+
+def halton(m, dim, digits=HALTON_DIGITS):
+    """
+    Symbolic scrambled Halton points 0, ..., m-1 of dimension dim, as a (m, dim) tensor.
+
+    Dimension c uses the c-th prime as base. Digit k of base b is scrambled with
+    d -> a*d mod b, where the multiplier a in [1, b) is fixed for each base and digit position,
+    which breaks the correlations between the dimensions of large bases.
+    """
+    bases = np.asarray(primes(dim), dtype=np.float64)[:, None]
+    powers = bases**np.arange(digits)
+    #Fixed multipliers, so that the graph only depends on dim and the function cache applies.
+    multipliers = np.floor(np.random.RandomState(0).uniform(size=powers.shape)*(bases - 1)) + 1
+    index = T.cast(T.arange(m), 'float64').dimshuffle(0, 'x', 'x')
+    digit_values = T.floor(index / powers) % bases
+    scrambled = (digit_values*multipliers) % bases
+    return T.sum(scrambled / (powers*bases), axis=2)
+
+
+def uniform_noise(trng, size, noise='iid'):
+    """
+    Draws uniform noise of shape size = (m, n_examples, n_units) with the given generator. m and
+    n_examples can be symbolic, n_units must be an int for 'halton'.
+
+    :type trng: theano.tensor.shared_randomstreams.RandomStreams.
+    :param trng: random streams used for the random part of every generator.
+
+    :type noise: string.
+    :param noise: one of NOISE.
+    """
+    m, rows, cols = size
+    if noise == 'iid':
+        return trng.uniform(size=size)
+    elif noise == 'stratified':
+        strata = T.argsort(trng.uniform(size=size), axis=0)
+        sample = (strata + trng.uniform(size=size)) / m
+    elif noise == 'antithetic':
+        half = trng.uniform(size=((m + 1) // 2, rows, cols))
+        sample = T.concatenate([half, 1 - half], axis=0)[:m]
+    elif noise == 'halton':
+        points = halton(m, int(cols)).dimshuffle(0, 'x', 1)
+        sample = points + trng.uniform(size=(rows, cols)).dimshuffle('x', 0, 1)
+        sample = sample - T.floor(sample)
+    else:
+        raise NotImplementedError, \
+        "Noise generator not implemented. Choose one out of: {0}".format(list(NOISE))
+    return T.cast(sample, theano.config.floatX)
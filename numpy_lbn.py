@@ -0,0 +1,583 @@
+import copy
+import multiprocessing
+import traceback
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import checkpoint
+import summary
+
+
+def _tanh(x, out):
+    return np.tanh(x, out=out)
+
+
+def _sigmoid(x, out):
+    with np.errstate(over='ignore'):
+        np.negative(x, out=out)
+        np.exp(out, out=out)
+    out += 1
+    return np.reciprocal(out, out=out)
+
+
+def _relu(x, out):
+    return np.maximum(x, 0, out=out)
+
+
+def _linear(x, out):
+    if out is not x:
+        out[...] = x
+    return out
+
+
+ACTIVATIONS = {'tanh': _tanh, 'sigmoid': _sigmoid, 'relu': _relu, 'linear': _linear}
+
+
+def get_activation_function(activation):
+    """
+    NumPy counterpart of util.get_activation_function. The returned function has the signature
+    f(x, out) and writes its result in out, which can be x itself.
+    """
+    try:
+        return ACTIVATIONS[activation]
+    except KeyError:
+        raise NotImplementedError, \
+        "Activation function not implemented. Choose one out of: {0}".format(sorted(ACTIVATIONS))
+
+
+class _NumpyEngine(object):
+    """
+    Random number generators and work buffers of the NumPy inference engines. Subclasses set
+    self.hidden_layers, self.dtype and self._buffers.
+    """
+    def seed(self, seed):
+        """
+        Resets the random number generators of the stochastic layers.
+
+        :type seed: int or list of ints.
+        :param seed: seed of the random number generators, anything accepted by
+                    numpy.random.RandomState.
+        """
+        seedgen = np.random.RandomState(seed)
+        self.layer_rngs = [np.random.RandomState(int(seedgen.randint(2**30)))
+                                                                    for _ in self.hidden_layers]
+
+    def _buffer(self, name, shape, dtype=None):
+        """Returns a preallocated buffer, it is only reallocated when the shape changes."""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=self.dtype if dtype is None else dtype)
+            self._buffers[name] = buf
+        return buf
+
+
+class NumpyLBN(_NumpyEngine):
+    """
+    Inference-only LBN that runs the stochastic forward pass of LBN.predict with NumPy. It loads
+    the networks written by LBN.save_network() and does not import Theano, so it does not compile
+    anything at start up.
+
+    The uniform draws follow the same streams as the RandomStreams of LBN: each LBN hidden layer
+    has its own numpy.random.RandomState seeded from a generator seeded with seed. Given the same
+    seed and the same sequence of calls both implementations draw the same samples.
+
+    By default the uniform noise and the Bernoulli gates of a layer are held for all the m
+    samples at once, as float64 and bool arrays of shape (m, n_samples, width). With
+    gates='uint8' or gates='packed' the noise is drawn in chunks of at most noise_chunk values,
+    the gates are kept as uint8 or bit-packed arrays and applied to the deterministic output by
+    masked selection. The draws are the same, so are the samples. See memory_report().
+    """
+    def __init__(self, network_description, seed=1234, dtype=np.float64, gates='bool',
+                                                                            noise_chunk=2**20):
+        """
+        :type network_description: dict.
+        :param network_description: network as generated in LBN.save_network(), with the
+                                    'network_properties' and 'layers' keys.
+
+        :type seed: int.
+        :param seed: seed of the random number generators used to sample.
+
+        :type dtype: numpy.dtype.
+        :param dtype: dtype of the weights and of the computations.
+
+        :type gates: string.
+        :param gates: 'bool' to draw the noise and gates of all samples at once, 'uint8' or
+                    'packed' (one bit per gate) for the chunked compact mode. The gates of the
+                    last prediction are kept in self.gates in the compact modes.
+
+        :type noise_chunk: int.
+        :param noise_chunk: maximum number of uniform values drawn at once in the compact modes.
+        """
+        assert gates in ('bool', 'uint8', 'packed'), \
+                                    "gates must be 'bool', 'uint8' or 'packed': {0!r}".format(gates)
+        network_properties = network_description['network_properties']
+        self.n_in = network_properties['n_in']
+        self.n_hidden = list(network_properties['n_hidden'])
+        self.n_out = network_properties['n_out']
+        self.det_activation_names = network_properties['det_activations']
+        self.stoch_activation_names = network_properties['stoch_activations']
+        self.stoch_n_hidden = network_properties['stoch_n_hidden']
+        self.dtype = np.dtype(dtype)
+
+        layers = network_description['layers']
+        self.hidden_layers = []
+        for l in layers['hidden_layers']:
+            det = l['LBNlayer']['detLayer']
+            stoch = [(np.asarray(h['detLayer']['W'], dtype=self.dtype).T,
+                      np.asarray(h['detLayer']['b'], dtype=self.dtype),
+                      get_activation_function(h['detLayer']['activation']))
+                                                        for h in l['LBNlayer']['stochLayer']]
+            #Weights are stored transposed so that every product is a plain x.dot(W).
+            self.hidden_layers.append({'W': np.asarray(det['W'], dtype=self.dtype).T,
+                                       'activation': get_activation_function(det['activation']),
+                                       'stoch_layers': stoch})
+        self.output_W = np.asarray(layers['output_layer']['W'], dtype=self.dtype).T
+        self.output_activation = get_activation_function(layers['output_layer']['activation'])
+
+        self.gate_storage = gates
+        self.noise_chunk = noise_chunk
+        self.gates = [None]*len(self.hidden_layers)
+        self._buffers = {}
+        self.seed(seed)
+
+    @classmethod
+    def init_from_file(cls, fname, mmap=False, **kwargs):
+        """
+        Loads a network saved with LBN.save_network().
+
+        :type fname: string.
+        :param fname: json file or binary checkpoint directory (with local or global path) from
+                    where to load the network.
+
+        :type mmap: bool.
+        :param mmap: if True the weights of a binary checkpoint are memory-mapped instead of read.
+
+        :param kwargs: extra keyword arguments passed to the constructor.
+        """
+        return cls(checkpoint.load(fname, mmap=mmap), **kwargs)
+
+    def _mlp(self, k, x):
+        """Stochastic MLP of the LBN layer k applied to the 2D array x. Returns ph."""
+        for i, (W, b, activation) in enumerate(self.hidden_layers[k]['stoch_layers']):
+            out = self._buffer(('mlp', k, i), (x.shape[0], W.shape[1]))
+            np.dot(x, W, out=out)
+            out += b
+            x = activation(out, out)
+        return x
+
+    def predict(self, x, m):
+        """
+        Draws m samples of the network output, like LBN.predict.
+
+        :type x: numpy.array or scipy.sparse matrix.
+        :param x: input data of shape (n_samples, n_in).
+
+        :type m: int.
+        :param m: number of samples drawn from the network.
+
+        :returns: numpy.array of shape (m, n_samples, n_out).
+        """
+        #scipy.sparse matrices are recognised by their tocsr() method, so scipy is not required.
+        x = x.tocsr().astype(self.dtype) if hasattr(x, 'tocsr') else np.asarray(x, dtype=self.dtype)
+        n = x.shape[0]
+        h = x
+        for k, layer in enumerate(self.hidden_layers):
+            W = layer['W']
+            #The first layer input is shared by the m samples so it is only projected once.
+            rows = n if k == 0 else m*n
+            no_bias_output = self._buffer(('det', k), (rows, W.shape[1]))
+            if k == 0 and hasattr(h, 'tocsr'):
+                no_bias_output[...] = h.dot(W)
+            else:
+                np.dot(h.reshape(rows, -1), W, out=no_bias_output)
+            ph = self._mlp(k, no_bias_output)
+            det_output = layer['activation'](no_bias_output,
+                                                    self._buffer(('act', k), ph.shape))
+            if self.gate_storage != 'bool':
+                h = self._compact_gates(k, ph, det_output, m, n)
+                continue
+            sample = self.layer_rngs[k].uniform(0., 1., size=(m, n, W.shape[1]))
+            if k > 0:
+                sample = sample.reshape(ph.shape)
+            #Bernoulli gates with probability ph. The samples of the first layer broadcast ph and
+            #det_output along the m axis.
+            gate = self._buffer(('gate', k), sample.shape, dtype=bool)
+            np.less(sample, ph, out=gate)
+            h = self._buffer(('out', k), sample.shape)
+            np.multiply(gate, det_output, out=h)
+        output = np.dot(h.reshape(m*n, -1), self.output_W)
+        self.output_activation(output, output)
+        return output.reshape(m, n, self.n_out)
+
+    def _samples_per_chunk(self, n, width):
+        return max(1, self.noise_chunk // (n*width))
+
+    def _compact_gates(self, k, ph, det_output, m, n):
+        """
+        Samples the gates of layer k in chunks of samples. Each chunk of uniform noise is turned
+        into boolean gates that select the deterministic output, and the gates are stored
+        compactly in self.gates[k]. Returns the layer output of shape (m*n, width).
+        """
+        width = ph.shape[1]
+        if self.gate_storage == 'packed':
+            gates = self._buffer(('gate', k), (m*n, (width + 7)//8), dtype=np.uint8)
+        else:
+            gates = self._buffer(('gate', k), (m*n, width), dtype=np.uint8)
+        h = self._buffer(('out', k), (m*n, width))
+        h.fill(0)
+        step = self._samples_per_chunk(n, width)
+        for start in xrange(0, m, step):
+            stop = min(m, start + step)
+            rows = slice(start*n, stop*n)
+            shape = (stop - start, n, width)
+            sample = self.layer_rngs[k].uniform(0., 1., size=shape)
+            #The first layer ph and det_output have n rows that broadcast over the samples.
+            if ph.shape[0] == m*n:
+                gate = np.less(sample, ph[rows].reshape(shape))
+                np.copyto(h[rows].reshape(shape), det_output[rows].reshape(shape), where=gate)
+            else:
+                gate = np.less(sample, ph)
+                np.copyto(h[rows].reshape(shape), det_output, where=gate)
+            gate = gate.reshape(-1, width)
+            if self.gate_storage == 'packed':
+                gates[rows] = np.packbits(gate, axis=1)
+            else:
+                gates[rows] = gate
+        self.gates[k] = gates
+        return h
+
+    def unpacked_gates(self, k):
+        """Gates of layer k in the last prediction as a bool array of shape (m*n, width)."""
+        gates = self.gates[k]
+        if self.gate_storage == 'packed':
+            width = self.hidden_layers[k]['W'].shape[1]
+            return np.unpackbits(gates, axis=1)[:, :width].astype(bool)
+        return gates.view(bool)
+
+    def memory_report(self, n_samples, m):
+        """
+        Bytes held per LBN hidden layer by the uniform noise, the gates and the layer output for
+        a prediction of m samples of n_samples inputs, both in the 'bool' mode and in the mode of
+        this network.
+
+        :returns: list with a dict per layer: {'bool': {...}, 'compact': {...}} where each entry
+                has the 'noise', 'gates', 'output' and 'total' bytes. In the compact modes
+                'noise' includes the boolean gates of a chunk.
+        """
+        report = []
+        rows = m*n_samples
+        for layer in self.hidden_layers:
+            width = layer['W'].shape[1]
+            output = rows*width*self.dtype.itemsize
+            full = {'noise': rows*width*8, 'gates': rows*width, 'output': output}
+            chunk_rows = min(m, self._samples_per_chunk(n_samples, width))*n_samples
+            gate_bytes = rows*((width + 7)//8) if self.gate_storage == 'packed' else rows*width
+            compact = {'noise': chunk_rows*width*(8 + 1), 'gates': gate_bytes, 'output': output}
+            for r in (full, compact):
+                r['total'] = r['noise'] + r['gates'] + r['output']
+            report.append({'bool': full, 'compact': compact})
+        return report
+
+    def predict_summary(self, x, m, m_chunk, **kwargs):
+        """
+        Mean, variance and optionally quantiles and histograms of the predictive distribution,
+        estimated from m samples drawn in chunks of m_chunk samples. See
+        summary.predict_summary() for the options.
+        """
+        return summary.predict_summary(self.predict, x, m, m_chunk, **kwargs)
+
+
+class EnsembleLBN(_NumpyEngine):
+    """
+    Inference-only ensemble of LBNs with the same network_properties, e.g. bootstrap or
+    per-region models. The weights of the members are stacked along a leading model axis, so
+    that all the members are evaluated in one batched forward pass: the first layer is a single
+    product of the input with the concatenated weights of all the members and the other layers
+    are batched products over the model axis. Only the stacked copy of the weights is kept.
+
+    Each LBN hidden layer has its own numpy.random.RandomState seeded from a generator seeded
+    with seed, which draws the noise of all the members at once.
+    """
+    def __init__(self, network_descriptions, seed=1234, dtype=np.float64, noise_chunk=2**16):
+        """
+        :type network_descriptions: list of dicts.
+        :param network_descriptions: networks as generated in LBN.save_network(), with the
+                                    'network_properties' and 'layers' keys.
+
+        :type seed: int.
+        :param seed: seed of the random number generators used to sample.
+
+        :type dtype: numpy.dtype.
+        :param dtype: dtype of the weights and of the computations.
+
+        :type noise_chunk: int.
+        :param noise_chunk: the samples are propagated in chunks of at most about noise_chunk
+                        uniform draws per layer.
+        """
+        assert len(network_descriptions) > 0, "At least one network is required."
+        network_properties = network_descriptions[0]['network_properties']
+        for i, d in enumerate(network_descriptions[1:]):
+            assert d['network_properties'] == network_properties, \
+                    "network_properties of network {0} do not match those of network 0: {1!r} " \
+                    "and {2!r}".format(i + 1, d['network_properties'], network_properties)
+        self.n_models = len(network_descriptions)
+        self.n_in = network_properties['n_in']
+        self.n_hidden = list(network_properties['n_hidden'])
+        self.n_out = network_properties['n_out']
+        self.det_activation_names = network_properties['det_activations']
+        self.stoch_activation_names = network_properties['stoch_activations']
+        self.stoch_n_hidden = network_properties['stoch_n_hidden']
+        self.dtype = np.dtype(dtype)
+
+        layers = [d['layers'] for d in network_descriptions]
+
+        def stack(get, transpose=True):
+            #Weights are stored transposed so that every product is a plain x.dot(W).
+            arrays = [np.asarray(get(l), dtype=self.dtype) for l in layers]
+            return np.array([a.T if transpose else a for a in arrays])
+
+        self.hidden_layers = []
+        for k, info in enumerate(layers[0]['hidden_layers']):
+            det = lambda l: l['hidden_layers'][k]['LBNlayer']['detLayer']
+            stoch = []
+            for i, h in enumerate(info['LBNlayer']['stochLayer']):
+                h_layer = lambda l: l['hidden_layers'][k]['LBNlayer']['stochLayer'][i]['detLayer']
+                stoch.append((stack(lambda l: h_layer(l)['W']),
+                              stack(lambda l: h_layer(l)['b'], transpose=False)[:, None, :],
+                              get_activation_function(h['detLayer']['activation'])))
+            activation = get_activation_function(info['LBNlayer']['detLayer']['activation'])
+            self.hidden_layers.append({'W': stack(lambda l: det(l)['W']), 'activation': activation,
+                                       'stoch_layers': stoch})
+        #The input is shared by all the members, so their first layer weights are concatenated.
+        W = self.hidden_layers[0]['W']
+        self.hidden_layers[0]['W'] = np.ascontiguousarray(W.transpose(1, 0, 2)).reshape(
+                                                                                W.shape[1], -1)
+        self.output_W = stack(lambda l: l['output_layer']['W'])
+        self.output_activation = get_activation_function(layers[0]['output_layer']['activation'])
+        self.noise_chunk = noise_chunk
+        self._buffers = {}
+        self.seed(seed)
+
+    @classmethod
+    def init_from_file(cls, fnames, mmap=False, **kwargs):
+        """
+        Loads networks saved with LBN.save_network().
+
+        :type fnames: list of strings.
+        :param fnames: json files or binary checkpoint directories of the members.
+
+        :type mmap: bool.
+        :param mmap: if True the weights of binary checkpoints are memory-mapped while they are
+                    stacked, so that only the stacked copy is read into memory.
+
+        :param kwargs: extra keyword arguments passed to the constructor.
+        """
+        return cls([checkpoint.load(fname, mmap=mmap) for fname in fnames], **kwargs)
+
+    def _mlp(self, k, x):
+        """Stochastic MLPs of the LBN layer k applied to x of shape (n_models, rows, n)."""
+        for W, b, activation in self.hidden_layers[k]['stoch_layers']:
+            out = np.matmul(x, W)
+            out += b
+            x = activation(out, out)
+        return x
+
+    def predict(self, x, m, pooled=False):
+        """
+        Draws m samples of the output of every member.
+
+        :type x: numpy.array or scipy.sparse matrix.
+        :param x: input data of shape (n_samples, n_in).
+
+        :type m: int.
+        :param m: number of samples drawn from each member.
+
+        :type pooled: bool.
+        :param pooled: if True the samples of all the members are returned together as samples
+                    of the mixture predictive, where every member has the same weight.
+
+        :returns: numpy.array of shape (n_models, m, n_samples, n_out), or
+                (n_models*m, n_samples, n_out) if pooled.
+        """
+        x = x.tocsr().astype(self.dtype) if hasattr(x, 'tocsr') else np.asarray(x, dtype=self.dtype)
+        n = x.shape[0]
+        n_models = self.n_models
+        #The first layer input is shared by the m samples so it is only projected once.
+        first = self.hidden_layers[0]
+        no_bias_output = x.dot(first['W']).reshape(n, n_models, -1).transpose(1, 0, 2)
+        first_ph = self._mlp(0, no_bias_output)[:, None]
+        first_det_output = first['activation'](no_bias_output, np.empty(no_bias_output.shape,
+                                                                        dtype=self.dtype))[:, None]
+        output = np.empty((n_models, m, n, self.n_out), dtype=self.dtype)
+        #The samples go through the network in chunks so that the arrays of all the members
+        #stay small.
+        step = max(1, self.noise_chunk // (n_models*n*max(self.n_hidden)))
+        for start in xrange(0, m, step):
+            stop = min(m, start + step)
+            h = None
+            for k, layer in enumerate(self.hidden_layers):
+                if k == 0:
+                    ph, det_output = first_ph, first_det_output
+                    width = ph.shape[3]
+                else:
+                    no_bias_output = np.matmul(h, layer['W'])
+                    width = no_bias_output.shape[2]
+                    ph = self._mlp(k, no_bias_output)
+                    det_output = layer['activation'](no_bias_output,
+                                                self._buffer(('act', k), no_bias_output.shape))
+                shape = (n_models, stop - start, n, width)
+                sample = self.layer_rngs[k].uniform(0., 1., size=shape)
+                gate = self._buffer(('gate', k), shape, dtype=bool)
+                np.less(sample, ph.reshape(shape) if k > 0 else ph, out=gate)
+                h = self._buffer(('out', k), shape)
+                np.multiply(gate, det_output.reshape(shape) if k > 0 else det_output, out=h)
+                h = h.reshape(n_models, -1, width)
+            chunk_output = np.matmul(h, self.output_W)
+            self.output_activation(chunk_output, chunk_output)
+            output[:, start:stop] = chunk_output.reshape(n_models, stop - start, n, self.n_out)
+        if pooled:
+            return output.reshape(n_models*m, n, self.n_out)
+        return output
+
+    def predict_summary(self, x, m, m_chunk, **kwargs):
+        """
+        Mean, variance and optionally quantiles and histograms of the mixture predictive,
+        estimated from m samples of each member drawn in chunks of m_chunk samples. See
+        summary.predict_summary() for the options.
+        """
+        return summary.predict_summary(lambda x, m: self.predict(x, m, pooled=True), x, m,
+                                                                            m_chunk, **kwargs)
+
+
+def _sampler_worker(network, connection):
+    """Process of a ParallelSampler: serves ('predict', x, m) and ('seed', seed) commands."""
+    try:
+        while True:
+            command = connection.recv()
+            if command[0] == 'stop':
+                break
+            elif command[0] == 'seed':
+                network.seed(command[1])
+                connection.send(('ok', None))
+            else:
+                connection.send(('ok', network.predict(command[1], command[2])))
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+class ParallelSampler(object):
+    """
+    Splits the m samples of NumpyLBN.predict among n_workers threads or processes. Every worker
+    owns a copy of the network with its own buffers and random number generators, seeded with
+    [seed, worker], so the streams of the workers are independent and the output only depends
+    on the seed, the number of workers and the sequence of calls. Worker w draws the w-th
+    contiguous block of samples along the m axis.
+
+    Threads share the weights and run in parallel while NumPy releases the GIL (products,
+    element-wise operations, random number generation). Processes are forked once when the
+    sampler is created, share the weights copy-on-write and send their samples back through
+    pipes.
+    """
+    def __init__(self, network, n_workers, backend='thread', seed=1234):
+        """
+        :type network: NumpyLBN.
+        :param network: network to sample from.
+
+        :type n_workers: int.
+        :param n_workers: number of workers.
+
+        :type backend: string.
+        :param backend: 'thread' or 'process'.
+
+        :type seed: int.
+        :param seed: seed of the workers' random number generators.
+        """
+        assert backend in ('thread', 'process'), \
+                                    "backend must be 'thread' or 'process': {0!r}".format(backend)
+        self.network = network
+        self.n_workers = n_workers
+        self.backend = backend
+        self.n_out = network.n_out
+        self.workers = []
+        for w in xrange(n_workers):
+            worker = copy.copy(network)
+            worker._buffers = {}
+            worker.gates = [None]*len(network.hidden_layers)
+            worker.seed([seed, w])
+            self.workers.append(worker)
+        if backend == 'thread':
+            self.pool = ThreadPool(n_workers)
+        else:
+            self.connections = []
+            self.processes = []
+            for worker in self.workers:
+                parent_connection, child_connection = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_sampler_worker,
+                                                            args=(worker, child_connection))
+                process.daemon = True
+                process.start()
+                self.connections.append(parent_connection)
+                self.processes.append(process)
+
+    def _split(self, m):
+        sizes = [m // self.n_workers + (1 if w < m % self.n_workers else 0)
+                                                                for w in xrange(self.n_workers)]
+        return [(w, size) for w, size in enumerate(sizes) if size > 0]
+
+    @staticmethod
+    def _receive(connection):
+        reply = connection.recv()
+        if reply[0] == 'error':
+            raise RuntimeError("Sampling worker failed:\n{0}".format(reply[1]))
+        return reply[1]
+
+    def seed(self, seed):
+        """Reseeds worker w with [seed, w]."""
+        for w, worker in enumerate(self.workers):
+            if self.backend == 'thread':
+                worker.seed([seed, w])
+            else:
+                self.connections[w].send(('seed', [seed, w]))
+                self._receive(self.connections[w])
+
+    def predict(self, x, m):
+        """
+        Draws m samples of the network output in parallel. x is a numpy.array or a scipy.sparse
+        matrix, converted once to CSR before it is shared with the workers.
+
+        :returns: numpy.array of shape (m, n_samples, n_out).
+        """
+        x = x.tocsr() if hasattr(x, 'tocsr') else np.asarray(x)
+        parts = self._split(m)
+        if self.backend == 'thread':
+            samples = self.pool.map(lambda (w, size): self.workers[w].predict(x, size), parts)
+        else:
+            for w, size in parts:
+                self.connections[w].send(('predict', x, size))
+            samples = [self._receive(self.connections[w]) for w, _ in parts]
+        if len(samples) == 1:
+            return samples[0]
+        return np.concatenate(samples)
+
+    def close(self):
+        """Stops the workers."""
+        if self.backend == 'thread':
+            self.pool.close()
+            self.pool.join()
+            return
+        for c in self.connections:
+            try:
+                c.send(('stop',))
+            except IOError:
+                pass
+        for p in self.processes:
+            p.join()
+        self.connections = []
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
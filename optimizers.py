@@ -0,0 +1,236 @@
+"""
+Optimizers and learning rate schedules used by LBN.fit(). An optimizer turns gradients into the
+list of updates of the compiled train_model. Its state (iteration counter, velocities, moment
+estimates) is kept in shared variables, so it persists between calls and can be saved with
+get_state() and restored with set_state(). The variables of a parameter are created the first
+time its updates are built and reused afterwards, so an optimizer given to several fit() or
+partial_fit() calls keeps a single state.
+"""
+import numpy as np
+import theano
+import theano.tensor as T
+
+
+class StepDecay(object):
+    """Multiplies the learning rate by drop every `steps` updates."""
+    def __init__(self, drop, steps):
+        self.drop = drop
+        self.steps = steps
+
+    def __call__(self, learning_rate, t):
+        return learning_rate * self.drop**T.floor(t / self.steps)
+
+    def settings(self):
+        return {'schedule': 'step', 'drop': self.drop, 'steps': self.steps}
+
+
+class ExponentialDecay(object):
+    """learning_rate * rate**(t / steps)."""
+    def __init__(self, rate, steps):
+        self.rate = rate
+        self.steps = steps
+
+    def __call__(self, learning_rate, t):
+        return learning_rate * self.rate**(t / float(self.steps))
+
+    def settings(self):
+        return {'schedule': 'exponential', 'rate': self.rate, 'steps': self.steps}
+
+
+class InverseTimeDecay(object):
+    """learning_rate / (1 + rate * t / steps)."""
+    def __init__(self, rate, steps):
+        self.rate = rate
+        self.steps = steps
+
+    def __call__(self, learning_rate, t):
+        return learning_rate / (1. + self.rate * t / float(self.steps))
+
+    def settings(self):
+        return {'schedule': 'inverse_time', 'rate': self.rate, 'steps': self.steps}
+
+
+class Optimizer(object):
+    """
+    Base class of the optimizers. Subclasses implement _updates(params, grads, learning_rate).
+    """
+    def __init__(self, learning_rate, schedule=None, clip_norm=None):
+        """
+        :type learning_rate: float.
+        :param learning_rate: base step size.
+
+        :type schedule: StepDecay, ExponentialDecay or InverseTimeDecay.
+        :param schedule: learning rate schedule as a function of the number of updates. If None
+                        the learning rate is constant.
+
+        :type clip_norm: float.
+        :param clip_norm: if set, gradients are rescaled so that their global L2 norm is at most
+                        clip_norm.
+        """
+        self.learning_rate = learning_rate
+        self.schedule = schedule
+        self.clip_norm = clip_norm
+        #Integer counter, a float32 one would stop incrementing after 2**24 updates.
+        self.iteration = theano.shared(np.asarray(0, dtype=np.int64), name='iteration')
+        self.state = [self.iteration]
+        #(id of the parameter, name) -> (parameter, state variable).
+        self._slots = {}
+
+    def _shared_like(self, param, name):
+        """Returns the state variable name of param, created on the first call."""
+        key = (id(param), name)
+        if key not in self._slots:
+            value = param.get_value(borrow=True)
+            s = theano.shared(np.zeros(value.shape, dtype=value.dtype), name=name,
+                                                                broadcastable=param.broadcastable)
+            #The parameter is kept so that its id is not reused by another object.
+            self._slots[key] = (param, s)
+            self.state.append(s)
+        return self._slots[key][1]
+
+    def _float_iteration(self, offset=0):
+        """Number of updates plus offset as a float64 scalar."""
+        return T.cast(self.iteration + offset, 'float64')
+
+    def get_updates(self, params, grads):
+        """
+        Returns the list of (shared variable, new value) updates of one optimization step.
+
+        :type params: list of theano.SharedVariable.
+        :param params: parameters to optimize.
+
+        :type grads: list of theano variables.
+        :param grads: gradients of the cost with respect to params.
+        """
+        if self.clip_norm is not None:
+            norm = T.sqrt(sum(T.sum(g**2) for g in grads))
+            scale = T.minimum(1., self.clip_norm / (norm + 1e-12))
+            grads = [g*scale for g in grads]
+        if self.schedule is None:
+            learning_rate = self.learning_rate
+        else:
+            learning_rate = T.cast(self.schedule(self.learning_rate, self._float_iteration()),
+                                                                        theano.config.floatX)
+        return self._updates(params, grads, learning_rate) + \
+                                                    [(self.iteration, self.iteration + 1)]
+
+    def settings(self):
+        """Values embedded in the graph of the updates, used as compiled function cache key."""
+        settings = {'optimizer': self.__class__.__name__, 'learning_rate': self.learning_rate,
+                    'clip_norm': self.clip_norm}
+        if self.schedule is not None:
+            settings.update(self.schedule.settings())
+        return settings
+
+    def get_state(self):
+        """Returns the values of the state variables."""
+        return [s.get_value() for s in self.state]
+
+    def set_state(self, values):
+        """Restores values returned by get_state() after get_updates() created the state."""
+        assert len(values) == len(self.state), "Optimizer state does not match."
+        for s, v in zip(self.state, values):
+            s.set_value(np.asarray(v, dtype=s.dtype))
+
+
+class SGD(Optimizer):
+    """Plain stochastic gradient descent: param - learning_rate * grad."""
+    def _updates(self, params, grads, learning_rate):
+        return [(p, p - learning_rate*g) for p, g in zip(params, grads)]
+
+
+class Momentum(Optimizer):
+    """Classical or Nesterov momentum."""
+    def __init__(self, learning_rate, momentum=0.9, nesterov=False, **kwargs):
+        super(Momentum, self).__init__(learning_rate, **kwargs)
+        self.momentum = momentum
+        self.nesterov = nesterov
+
+    def _updates(self, params, grads, learning_rate):
+        updates = []
+        for p, g in zip(params, grads):
+            velocity = self._shared_like(p, 'velocity')
+            new_velocity = self.momentum*velocity - learning_rate*g
+            updates.append((velocity, new_velocity))
+            if self.nesterov:
+                updates.append((p, p + self.momentum*new_velocity - learning_rate*g))
+            else:
+                updates.append((p, p + new_velocity))
+        return updates
+
+    def settings(self):
+        settings = super(Momentum, self).settings()
+        settings.update({'momentum': self.momentum, 'nesterov': self.nesterov})
+        return settings
+
+
+class RMSProp(Optimizer):
+    def __init__(self, learning_rate, rho=0.9, epsilon=1e-6, **kwargs):
+        super(RMSProp, self).__init__(learning_rate, **kwargs)
+        self.rho = rho
+        self.epsilon = epsilon
+
+    def _updates(self, params, grads, learning_rate):
+        updates = []
+        for p, g in zip(params, grads):
+            mean_square = self._shared_like(p, 'mean_square')
+            new_mean_square = self.rho*mean_square + (1 - self.rho)*g**2
+            updates.append((mean_square, new_mean_square))
+            updates.append((p, p - learning_rate*g/T.sqrt(new_mean_square + self.epsilon)))
+        return updates
+
+    def settings(self):
+        settings = super(RMSProp, self).settings()
+        settings.update({'rho': self.rho, 'epsilon': self.epsilon})
+        return settings
+
+
+class Adam(Optimizer):
+    def __init__(self, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-8, **kwargs):
+        super(Adam, self).__init__(learning_rate, **kwargs)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def _updates(self, params, grads, learning_rate):
+        t = self._float_iteration(1)
+        correction = T.cast(T.sqrt(1 - self.beta2**t)/(1 - self.beta1**t), theano.config.floatX)
+        updates = []
+        for p, g in zip(params, grads):
+            first_moment = self._shared_like(p, 'first_moment')
+            second_moment = self._shared_like(p, 'second_moment')
+            new_first_moment = self.beta1*first_moment + (1 - self.beta1)*g
+            new_second_moment = self.beta2*second_moment + (1 - self.beta2)*g**2
+            updates.append((first_moment, new_first_moment))
+            updates.append((second_moment, new_second_moment))
+            updates.append((p, p - learning_rate*correction*new_first_moment /
+                                                        (T.sqrt(new_second_moment) + self.epsilon)))
+        return updates
+
+    def settings(self):
+        settings = super(Adam, self).settings()
+        settings.update({'beta1': self.beta1, 'beta2': self.beta2, 'epsilon': self.epsilon})
+        return settings
+
+
+OPTIMIZERS = {'sgd': SGD, 'momentum': Momentum, 'rmsprop': RMSProp, 'adam': Adam}
+
+
+def get_optimizer(optimizer, learning_rate, schedule=None, clip_norm=None):
+    """
+    Returns an Optimizer.
+
+    :type optimizer: string or Optimizer.
+    :param optimizer: one of 'sgd', 'momentum', 'nesterov', 'rmsprop' and 'adam', or an Optimizer
+                    that is returned as is.
+    """
+    if isinstance(optimizer, Optimizer):
+        return optimizer
+    if optimizer == 'nesterov':
+        return Momentum(learning_rate, nesterov=True, schedule=schedule, clip_norm=clip_norm)
+    try:
+        return OPTIMIZERS[optimizer](learning_rate, schedule=schedule, clip_norm=clip_norm)
+    except KeyError:
+        raise NotImplementedError, \
+        "Optimizer not implemented. Choose one out of: {0}".format(sorted(OPTIMIZERS) +
+                                                                                    ['nesterov'])
@@ -0,0 +1,256 @@
+"""
+Data-parallel training of an LBN with several processes, see LBN.fit_parallel().
+
+Each worker process builds its own copy of the network, owns a contiguous shard of the training
+set and computes gradients on its minibatches. The parameters live in shared memory and the
+Theano shared variables of every worker use them without copying, so an update written by any
+process is seen by all the others.
+
+Two modes are available:
+    - 'sync': in each step every worker computes the gradient of its k-th minibatch, the parent
+      process adds them and applies the update. This is the gradient of the union of the
+      minibatches with the same scaling as fit(), which divides by the number of training
+      examples and not by the batch size. The result is reproducible for a fixed seed and
+      number of workers.
+    - 'async': every worker applies its own updates to the shared parameters without locks
+      (Hogwild!). Updates may interleave differently from run to run, so results are not
+      reproducible.
+"""
+import multiprocessing
+import time
+import traceback
+import numpy as np
+import theano
+import theano.tensor as T
+from function_cache import FunctionCache
+
+
+def buffer_views(buffer, shapes):
+    """
+    Splits a flat shared-memory buffer, e.g. a multiprocessing.RawArray of floatX values, in
+    numpy arrays of the given shapes. The arrays use the memory of the buffer without copying,
+    so processes that inherit the buffer see the writes of each other.
+    """
+    flat = np.frombuffer(buffer, dtype=theano.config.floatX)
+    views = []
+    start = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(flat[start:start + size].reshape(shape))
+        start += size
+    return views
+
+
+def _worker(cls, worker_id, network_description, noise, vectorized, x, y, m, learning_rate,
+                batch_size, n_train, seed, mode, cache_dir, params_buffer, grad_buffer, connection):
+    try:
+        net = cls.from_description(network_description, noise=noise, vectorized=vectorized,
+                    function_cache=None if cache_dir is None else FunctionCache(cache_dir))
+        #The graph is built before seeding, RandomStreams.seed() only reseeds existing streams.
+        flat_params = [p for layer in net.params for p in layer]
+        net.trng.seed(seed + worker_id)
+        shapes = [p.get_value(borrow=True).shape for p in flat_params]
+        params = buffer_views(params_buffer, shapes)
+        for p, v in zip(flat_params, params):
+            p.set_value(v, borrow=True)
+
+        train_set_x = theano.shared(np.asarray(x, dtype=theano.config.floatX))
+        train_set_y = theano.shared(np.asarray(y, dtype=theano.config.floatX))
+        net.fiting_variables(batch_size, train_set_x, train_set_y)
+        gparams = [T.grad(-1./n_train*net.log_likelihood, p) for p in flat_params]
+        compute_gradient = net.compile_function('parallel_gradient',
+                                    settings={'m': m, 'batch_size': batch_size, 'n_train': n_train},
+                                    extra_shared=[train_set_x, train_set_y],
+                                    inputs=[net.index, net.n_ex],
+                                    outputs=[net.log_likelihood] + gparams,
+                                    givens={net.x: train_set_x[net.batch_start:net.batch_stop],
+                                            net.y: train_set_y[net.batch_start:net.batch_stop],
+                                            net.m: T.constant(m, dtype=net.m.dtype)})
+        grads = None if grad_buffer is None else buffer_views(grad_buffer, shapes)
+        connection.send(('ready',))
+
+        while True:
+            command = connection.recv()
+            if command[0] == 'stop':
+                break
+            start = time.time()
+            log_likelihood = 0.
+            if command[0] == 'step':
+                if command[1] < net.n_train_batches:
+                    outputs = compute_gradient(command[1], net.n_train)
+                    log_likelihood = outputs[0]
+                    for g, v in zip(outputs[1:], grads):
+                        v[...] = g
+                else:
+                    for v in grads:
+                        v[...] = 0
+            else:
+                for minibatch_idx in xrange(net.n_train_batches):
+                    outputs = compute_gradient(minibatch_idx, net.n_train)
+                    log_likelihood += outputs[0]
+                    for g, v in zip(outputs[1:], params):
+                        v -= learning_rate*g
+            connection.send((float(log_likelihood), time.time() - start))
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def _receive(connection):
+    reply = connection.recv()
+    if reply[0] == 'error':
+        raise RuntimeError("Training worker failed:\n{0}".format(reply[1]))
+    return reply
+
+
+def single_process_epoch_time(net, x, y, m, learning_rate, batch_size):
+    """
+    Measures the wall time of one epoch of plain SGD training in the current process, on a copy
+    of net so that its weights are not changed. Compilation and a first warm-up step are not
+    timed.
+    """
+    baseline = net.__class__.from_description(net.network_description(), noise=net.noise,
+                                vectorized=net.vectorized, function_cache=net.function_cache)
+    train_set_x = theano.shared(np.asarray(x, dtype=theano.config.floatX), borrow=True)
+    train_set_y = theano.shared(np.asarray(y, dtype=theano.config.floatX), borrow=True)
+    baseline.fiting_variables(batch_size, train_set_x, train_set_y)
+    train_model = baseline.compile_train_model(m, learning_rate, batch_size, x.shape[0],
+                                                                    train_set_x, train_set_y)
+    train_model(0, x.shape[0])
+    start = time.time()
+    for minibatch_index in xrange(int(np.ceil(1.0 * x.shape[0] / batch_size))):
+        train_model(minibatch_index, x.shape[0])
+    return time.time() - start
+
+
+def fit_parallel(net, x, y, m, learning_rate, epochs, batch_size, n_workers, mode='sync',
+                                                    seed=1234, cache_dir=None, baseline_time=None):
+    """
+    Trains net with n_workers processes. The parameters of net are updated at the end.
+
+    :type net: lbn.LBN.
+    :param net: network to train.
+
+    :type x: numpy.array.
+    :param x: input data of shape (n_samples, dimensionality).
+
+    :type y: numpy.array.
+    :param y: output data of shape (n_samples, n_out).
+
+    :type m: int.
+    :param m: number of samples drawn from the network.
+
+    :type learning_rate: float.
+    :param learning_rate: step size of the updates.
+
+    :type epochs: int.
+    :param epochs: number of training epochs.
+
+    :type batch_size: int
+    :param batch_size: minibatch size of each worker.
+
+    :type n_workers: int.
+    :param n_workers: number of worker processes.
+
+    :type mode: string.
+    :param mode: 'sync' or 'async', see the module documentation.
+
+    :type seed: int.
+    :param seed: worker k seeds its random streams with seed + k.
+
+    :type cache_dir: string.
+    :param cache_dir: if set, workers share compiled functions through a FunctionCache stored
+                    in this directory.
+
+    :type baseline_time: float.
+    :param baseline_time: wall time in seconds of one epoch of training in a single process,
+                        against which the speedup is computed. By default it is measured with
+                        single_process_epoch_time() before the workers start.
+
+    :returns: list with a dict per epoch with the log likelihood (sum of the minibatch log
+            likelihoods), the wall time, the speedup (baseline_time over the wall time), the
+            scaling efficiency (speedup over n_workers), the time spent computing in the
+            workers and their utilization (compute time over n_workers times the wall time).
+            Workers that compete for cores compute more slowly than a single process, so the
+            utilization can be high while the speedup is low.
+    """
+    assert mode in ('sync', 'async'), "mode must be 'sync' or 'async': {0!r}".format(mode)
+    if baseline_time is None:
+        baseline_time = single_process_epoch_time(net, x, y, m, learning_rate, batch_size)
+    flat_params = [p for layer in net.params for p in layer]
+    shapes = [p.get_value(borrow=True).shape for p in flat_params]
+    n_params = sum(int(np.prod(s)) for s in shapes)
+    typecode = 'f' if theano.config.floatX == 'float32' else 'd'
+    params_buffer = multiprocessing.RawArray(typecode, n_params)
+    params = buffer_views(params_buffer, shapes)
+    for p, v in zip(flat_params, params):
+        v[...] = p.get_value(borrow=True)
+    grad_buffers = [multiprocessing.RawArray(typecode, n_params) if mode == 'sync' else None
+                                                                    for _ in xrange(n_workers)]
+    grads = [None if b is None else buffer_views(b, shapes) for b in grad_buffers]
+
+    network_description = net.network_description()
+    bounds = np.linspace(0, x.shape[0], n_workers + 1).astype(int)
+    connections = []
+    processes = []
+    for k in xrange(n_workers):
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_worker, args=(net.__class__, k,
+                                        network_description, net.noise, net.vectorized,
+                                        x[bounds[k]:bounds[k+1]], y[bounds[k]:bounds[k+1]], m,
+                                        learning_rate, batch_size, x.shape[0], seed, mode,
+                                        cache_dir, params_buffer, grad_buffers[k],
+                                        child_connection))
+        process.daemon = True
+        process.start()
+        connections.append(parent_connection)
+        processes.append(process)
+
+    n_steps = int(np.ceil(1.0 * np.max(np.diff(bounds)) / batch_size))
+    history = []
+    try:
+        #Workers build and compile their graph before the first epoch is timed.
+        for c in connections:
+            _receive(c)
+        for e in xrange(1, epochs+1):
+            start = time.time()
+            log_likelihood = 0.
+            compute_time = 0.
+            if mode == 'sync':
+                for step in xrange(n_steps):
+                    for c in connections:
+                        c.send(('step', step))
+                    for c in connections:
+                        step_likelihood, elapsed = _receive(c)
+                        log_likelihood += step_likelihood
+                        compute_time += elapsed
+                    for i, v in enumerate(params):
+                        v -= learning_rate*sum(g[i] for g in grads)
+            else:
+                for c in connections:
+                    c.send(('epoch',))
+                for c in connections:
+                    epoch_likelihood, elapsed = _receive(c)
+                    log_likelihood += epoch_likelihood
+                    compute_time += elapsed
+            wall_time = time.time() - start
+            speedup = baseline_time/wall_time
+            history.append({'epoch': e, 'log_likelihood': log_likelihood, 'wall_time': wall_time,
+                            'baseline_time': baseline_time, 'speedup': speedup,
+                            'scaling_efficiency': speedup/n_workers, 'compute_time': compute_time,
+                            'utilization': compute_time/(n_workers*wall_time)})
+            print "Epoch {0} log likelihood: {1} (speedup {2:.2f}, scaling efficiency " \
+                    "{3:.2f})".format(e, log_likelihood, speedup, history[-1]['scaling_efficiency'])
+    finally:
+        for c in connections:
+            try:
+                c.send(('stop',))
+            except IOError:
+                pass
+        for p in processes:
+            p.join()
+
+    for p, v in zip(flat_params, params):
+        p.set_value(np.array(v))
+    return history
@@ -0,0 +1,233 @@
+"""
+Cache of predictions for repeated queries. Serving traffic often asks again for the same input rows
+with the same number of samples. When the network is reseeded before every call its samples only
+depend on the input, so they can be kept and returned again without a forward pass.
+
+Results are cached per row, under a hash of the bytes of the row, the number of samples (and the
+other arguments of the call), the seed and the version of the weights. In a batch only the rows
+that miss go through the network, in a single call. Entries are evicted in least recently used
+order once the arrays held exceed a byte budget.
+
+The samples of a row are those drawn in the call where it missed, so they depend on the other rows
+of that call. Repeated queries get the same samples back, as they would from a network reseeded
+before every call, but not necessarily the same samples as an uncached call with a different batch.
+"""
+import collections
+import hashlib
+import json
+import threading
+import numpy as np
+
+#Axis of the rows in the arrays returned by predict_summary().
+SUMMARY_ROW_AXES = {'mean': 0, 'variance': 0, 'standard_error': 0, 'quantiles': 1,
+                    'histogram': 0, 'n_outside': 0}
+
+
+def weights_version(network):
+    """
+    Returns a hash of the weights of an LBN, NumpyLBN or EnsembleLBN, or of the network sampled
+    by a ParallelSampler.
+    """
+    digest = hashlib.sha1()
+    network = getattr(network, 'network', network)
+    if hasattr(network, 'output_W'):
+        arrays = [network.output_W]
+        for layer in network.hidden_layers:
+            arrays.append(layer['W'])
+            arrays.extend(a for W, b, _ in layer['stoch_layers'] for a in (W, b))
+    elif hasattr(network, 'trng'):
+        arrays = [p.get_value(borrow=True) for layer in network.params for p in layer]
+    else:
+        raise ValueError, "Cannot read the weights of {0}, pass the version of the weights " \
+                                                        "explicitly.".format(type(network).__name__)
+    for a in arrays:
+        digest.update(np.ascontiguousarray(a).tobytes())
+    return digest.hexdigest()
+
+
+def _row_hashes(x):
+    """Returns the sha1 digest of every row of the 2D array or scipy.sparse matrix x."""
+    if hasattr(x, 'tocsr'):
+        x = x.tocsr()
+        prefix = 'csr' + x.dtype.str
+        return [hashlib.sha1(prefix + x.indices[start:stop].tobytes() +
+                                                        x.data[start:stop].tobytes()).digest()
+                            for start, stop in zip(x.indptr[:-1], x.indptr[1:])]
+    x = np.ascontiguousarray(x)
+    return [hashlib.sha1(x.dtype.str + row.tobytes()).digest() for row in x]
+
+
+class PredictionCache(object):
+    def __init__(self, network, max_bytes, seed=None, version=None):
+        """
+        :type network: LBN, NumpyLBN, EnsembleLBN or ParallelSampler.
+        :param network: network with predict(x, m), and with predict_summary() and seed() if they
+                        are used. The rows of its samples must be on their second to last axis.
+                        Its predict() is only called by one thread at a time.
+
+        :type max_bytes: int.
+        :param max_bytes: maximum number of bytes of the cached arrays.
+
+        :type seed: int.
+        :param seed: if set, the network is reseeded with seed before computing the rows that
+                    missed. If None the network is not reseeded and the cache keeps the first
+                    samples drawn for each row.
+
+        :type version: string.
+        :param version: version of the weights. By default a hash of the weights of the network,
+                        see weights_version().
+        """
+        self.network = network
+        self.max_bytes = max_bytes
+        self.seed = seed
+        self.version = weights_version(network) if version is None else version
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        #_lock guards the entries and the counters. _compute_lock makes reseeding the network
+        #and computing the rows that missed atomic, so that concurrent calls, e.g. from the
+        #threads of a PredictionServer, do not interleave them.
+        self._lock = threading.Lock()
+        self._compute_lock = threading.Lock()
+
+    def refresh(self, version=None):
+        """
+        Sets the version of the weights after they changed, e.g. after fit() or partial_fit().
+        Entries of older versions are no longer returned and are evicted as new ones come in.
+
+        :type version: string.
+        :param version: new version, by default the hash of the current weights.
+        """
+        self.version = weights_version(self.network) if version is None else version
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _get(self, keys):
+        """Returns the cached entry of every key, or None, and marks them recently used."""
+        found = []
+        with self._lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.entries[key] = entry
+                found.append(None if entry is None else entry[0])
+        return found
+
+    def _put(self, key, entry, nbytes):
+        with self._lock:
+            if nbytes > self.max_bytes or key in self.entries:
+                return
+            self.entries[key] = (entry, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def _lookup(self, x, call, compute, split):
+        """
+        Returns the cached results of the rows of x and computes those that missed.
+
+        :param call: arguments of the call that are part of the keys.
+        :param compute: function x -> result for the rows that missed.
+        :param split: function (result, j) -> (entry of row j, bytes of the entry).
+
+        :returns: list of entries, one per row.
+        """
+        prefix = json.dumps([call, self.seed, self.version], sort_keys=True)
+        keys = [prefix + h for h in _row_hashes(x)]
+        entries = self._get(keys)
+        #Repeated rows of the batch are only computed once.
+        missing = collections.OrderedDict()
+        for i, key in enumerate(keys):
+            if entries[i] is None:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            with self._compute_lock:
+                #Rows computed by another call while this one waited are not computed again.
+                for key, entry in zip(missing.keys(), self._get(missing.keys())):
+                    if entry is not None:
+                        for i in missing.pop(key):
+                            entries[i] = entry
+                if missing:
+                    rows = [r[0] for r in missing.values()]
+                    if self.seed is not None:
+                        self.network.seed(self.seed)
+                    result = compute(x[rows])
+                    for j, (key, duplicates) in enumerate(missing.items()):
+                        entry, nbytes = split(result, j)
+                        self._put(key, entry, nbytes)
+                        for i in duplicates:
+                            entries[i] = entry
+        #A miss is a row that went through the network, every other row is a hit.
+        with self._lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return entries
+
+    def predict(self, x, m):
+        """
+        Draws m samples of the network output, like LBN.predict, taking the rows already
+        predicted from the cache.
+
+        :type x: numpy.array or scipy.sparse matrix.
+        :param x: input data of shape (n_samples, n_in).
+
+        :returns: numpy.array with the samples of the rows on the second to last axis, of shape
+                (m, n_samples, n_out) for LBN.predict.
+        """
+        x = x.tocsr() if hasattr(x, 'tocsr') else np.atleast_2d(x)
+
+        def split(samples, j):
+            row = samples[..., j, :].copy()
+            return row, row.nbytes
+        entries = self._lookup(x, ['predict', m], lambda x: self.network.predict(x, m), split)
+        first = entries[0]
+        samples = np.empty(first.shape[:-1] + (len(entries), first.shape[-1]), dtype=first.dtype)
+        for i, row in enumerate(entries):
+            samples[..., i, :] = row
+        return samples
+
+    def predict_summary(self, x, m, m_chunk, **kwargs):
+        """
+        Summary of the predictive distribution, see summary.predict_summary(), taking the rows
+        already summarized with the same arguments from the cache. When tol stops the sampling
+        early the rows summarized in different calls may have a different number of draws, in
+        which case 'n_draws' is an array with the number of draws of each row.
+        """
+        x = x.tocsr() if hasattr(x, 'tocsr') else np.atleast_2d(x)
+
+        def split(result, j):
+            entry = {}
+            for name, value in result.items():
+                if name in SUMMARY_ROW_AXES:
+                    value = np.take(value, j, axis=SUMMARY_ROW_AXES[name])
+                entry[name] = value
+            return entry, sum(np.asarray(v).nbytes for v in entry.values())
+        entries = self._lookup(x, ['predict_summary', m, m_chunk, kwargs],
+                            lambda x: self.network.predict_summary(x, m, m_chunk, **kwargs), split)
+        result = {}
+        for name in entries[0]:
+            if name in SUMMARY_ROW_AXES:
+                result[name] = np.stack([e[name] for e in entries], axis=SUMMARY_ROW_AXES[name])
+            elif name == 'n_draws':
+                n_draws = np.array([e[name] for e in entries])
+                result[name] = int(n_draws[0]) if np.all(n_draws == n_draws[0]) else n_draws
+            else:
+                result[name] = entries[0][name]
+        return result
+
+    def report(self):
+        """Returns the hit and miss counters of the rows, the hit rate and the bytes held."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits/float(requests) if requests else 0.,
+                    'entries': len(self.entries), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes, 'evictions': self.evictions}
@@ -0,0 +1,272 @@
+"""
+Micro-batching prediction service. Concurrent prediction requests are queued and coalesced into a
+single call to the predict function of a network (LBN.predict or NumpyLBN.predict), whose
+(m, n_samples, n_out) output is split back to each caller.
+
+Python 2 has no asyncio, so results are delivered through PendingPrediction objects. Their
+add_done_callback() method lets event loops (tornado, twisted, asyncio through
+call_soon_threadsafe) be notified without blocking a thread.
+"""
+import collections
+import json
+import threading
+import time
+import BaseHTTPServer
+import Queue
+import SocketServer
+import numpy as np
+
+
+class PendingPrediction(object):
+    """Result of a request submitted to a PredictionServer."""
+    def __init__(self, x, m):
+        self.x = x
+        self.m = m
+        self.submitted = time.time()
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the prediction and returns the samples, of shape (m, n_rows, n_out).
+
+        :type timeout: float.
+        :param timeout: maximum number of seconds to wait. None waits forever.
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError("Prediction not ready after {0} seconds".format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, fn):
+        """Calls fn(self) when the prediction is done, from the thread that completes it."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+
+
+class PredictionServer(object):
+    def __init__(self, predict, max_batch_size=64, max_wait=0.005, n_threads=1,
+                                                                        latency_window=10000):
+        """
+        :type predict: function.
+        :param predict: function (x, m) -> numpy.array of shape (m, n_samples, n_out), e.g.
+                        LBN.predict. Compiled Theano functions and NumpyLBN.predict are not thread
+                        safe, so n_threads must be 1 for them unless each thread gets its own copy.
+
+        :type max_batch_size: int.
+        :param max_batch_size: maximum number of rows in a coalesced call.
+
+        :type max_wait: float.
+        :param max_wait: maximum number of seconds the first request of a batch waits for others.
+
+        :type n_threads: int.
+        :param n_threads: number of threads running predict.
+
+        :type latency_window: int.
+        :param latency_window: number of recent requests used for the latency percentiles.
+        """
+        self.predict_fn = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.n_threads = n_threads
+        self.requests = Queue.Queue()
+        self.batches = Queue.Queue(maxsize=2*n_threads)
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_rows = 0
+        #Requests submitted and not answered yet, wherever they are: in the request queue, held
+        #back by the batching thread for another m or in a batch waiting for or being predicted.
+        self.n_pending = 0
+        self._stats_lock = threading.Lock()
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        """Starts the batching thread and the prediction threads."""
+        if self._running:
+            return self
+        self._running = True
+        self._threads = [threading.Thread(target=self._batch_loop)] + \
+                    [threading.Thread(target=self._predict_loop) for _ in xrange(self.n_threads)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+        return self
+
+    def stop(self):
+        """Stops the threads once the queued requests are served."""
+        if not self._running:
+            return
+        self._running = False
+        self.requests.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit(self, x, m):
+        """
+        Queues a request and returns a PendingPrediction.
+
+        :type x: numpy.array.
+        :param x: input rows, of shape (n_rows, n_in) or (n_in,) for a single row.
+
+        :type m: int.
+        :param m: number of samples drawn from the network. Only requests with the same m are
+                coalesced.
+        """
+        assert self._running, "The server is not running, call start() first."
+        x = np.atleast_2d(x)
+        pending = PendingPrediction(x, m)
+        with self._stats_lock:
+            self.n_pending += 1
+        pending.add_done_callback(self._request_done)
+        self.requests.put(pending)
+        return pending
+
+    def _request_done(self, pending):
+        with self._stats_lock:
+            self.n_pending -= 1
+
+    def predict(self, x, m, timeout=None):
+        """Blocking in-process client: submits a request and waits for its result."""
+        return self.submit(x, m).result(timeout)
+
+    def _batch_loop(self):
+        #Requests that could not join the batch being collected. They are served first.
+        waiting = collections.deque()
+        stop = False
+        while not (stop and not waiting):
+            first = waiting.popleft() if waiting else self.requests.get()
+            if first is None:
+                break
+            batch = [first]
+            n_rows = first.x.shape[0]
+            for request in list(waiting):
+                if request.m == first.m and n_rows + request.x.shape[0] <= self.max_batch_size:
+                    waiting.remove(request)
+                    batch.append(request)
+                    n_rows += request.x.shape[0]
+            deadline = first.submitted + self.max_wait
+            while not stop and n_rows < self.max_batch_size:
+                timeout = deadline - time.time()
+                try:
+                    request = self.requests.get(timeout=timeout) if timeout > 0 else \
+                                                                    self.requests.get_nowait()
+                except Queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                elif request.m == first.m and n_rows + request.x.shape[0] <= self.max_batch_size:
+                    batch.append(request)
+                    n_rows += request.x.shape[0]
+                else:
+                    waiting.append(request)
+            self.batches.put(batch)
+        for _ in xrange(self.n_threads):
+            self.batches.put(None)
+
+    def _predict_loop(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            try:
+                samples = self.predict_fn(np.concatenate([r.x for r in batch]), batch[0].m)
+            except Exception as e:
+                for r in batch:
+                    r._set(exception=e)
+                continue
+            start = 0
+            now = time.time()
+            with self._stats_lock:
+                self.n_batches += 1
+                self.n_requests += len(batch)
+                self.n_rows += sum(r.x.shape[0] for r in batch)
+                self.latencies.extend(now - r.submitted for r in batch)
+            for r in batch:
+                stop = start + r.x.shape[0]
+                r._set(result=samples[:, start:stop])
+                start = stop
+
+    def stats(self):
+        """
+        Returns the queue depth, request, row and batch counters, the mean batch size in rows and
+        the 50th, 90th and 99th percentiles of the latency in seconds. The queue depth is the
+        number of submitted requests that are not answered yet.
+        """
+        with self._stats_lock:
+            latencies = np.array(self.latencies)
+            stats = {'queue_depth': self.n_pending, 'n_requests': self.n_requests,
+                     'n_rows': self.n_rows, 'n_batches': self.n_batches,
+                     'mean_batch_size': 1.0*self.n_rows/self.n_batches if self.n_batches else 0.}
+        for p in (50, 90, 99):
+            stats['latency_p{0}'.format(p)] = np.percentile(latencies, p) if latencies.size \
+                                                                                else None
+        return stats
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(server, host='localhost', port=8000):
+    """
+    Serves a running PredictionServer over HTTP, e.g. to test it locally. POST / with a JSON body
+    {"x": [[...], ...], "m": int} returns {"samples": [...]} with the (m, n_rows, n_out) samples.
+    GET /stats returns PredictionServer.stats(). Blocks until interrupted.
+    """
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            body = json.dumps(body)
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, server.stats())
+            else:
+                self._reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                samples = server.predict(np.asarray(request['x']), int(request['m']))
+            except Exception as e:
+                self._reply(400, {'error': str(e)})
+                return
+            self._reply(200, {'samples': samples.tolist()})
+
+        def log_message(self, *args):
+            pass
+
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
@@ -0,0 +1,86 @@
+"""
+Helpers to train on datasets that do not fit in memory, see LBN.fit_stream().
+"""
+import sys
+import threading
+import Queue
+import numpy as np
+
+
+def array_chunks(x, y, chunk_size):
+    """
+    Yields consecutive (x, y) chunks of chunk_size rows. With numpy.memmap arrays only the rows of
+    the current chunk are read.
+    """
+    assert x.shape[0] == y.shape[0], "x and y must have the same number of rows."
+    for start in xrange(0, x.shape[0], chunk_size):
+        yield x[start:start + chunk_size], y[start:start + chunk_size]
+
+
+class ChunkPrefetcher(object):
+    """
+    Iterates over (x, y) chunks while a background thread reads the next ones. Chunks are copied
+    into a fixed pool of preallocated buffers, so no memory is allocated per chunk. Iterating
+    yields (x_buffer, y_buffer, n_rows) where only the first n_rows rows of the buffers are valid.
+    A pair of buffers is handed back to the reading thread when the next chunk is requested.
+    """
+    def __init__(self, chunks, chunk_size, n_in, n_out, dtype, n_buffers=2):
+        """
+        :type chunks: iterable.
+        :param chunks: iterable of (x, y) pairs of arrays with at most chunk_size rows.
+
+        :type chunk_size: int.
+        :param chunk_size: number of rows of the buffers.
+
+        :type n_in: int.
+        :param n_in: number of columns of x.
+
+        :type n_out: int.
+        :param n_out: number of columns of y.
+
+        :type dtype: numpy.dtype.
+        :param dtype: dtype of the buffers.
+
+        :type n_buffers: int.
+        :param n_buffers: number of buffer pairs. With 2 the next chunk is read while the current
+                        one is used.
+        """
+        self.chunk_size = chunk_size
+        self.free = Queue.Queue()
+        self.ready = Queue.Queue()
+        for _ in xrange(n_buffers):
+            self.free.put((np.empty((chunk_size, n_in), dtype=dtype),
+                           np.empty((chunk_size, n_out), dtype=dtype)))
+        self.thread = threading.Thread(target=self._fill, args=(chunks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self, chunks):
+        try:
+            for x, y in chunks:
+                n_rows = x.shape[0]
+                if n_rows > self.chunk_size or y.shape[0] != n_rows:
+                    raise ValueError("Chunks must have at most {0} rows and x and y the same number"
+                                     " of rows, got {1} and {2}".format(self.chunk_size, n_rows,
+                                                                                    y.shape[0]))
+                x_buffer, y_buffer = self.free.get()
+                x_buffer[:n_rows] = x
+                y_buffer[:n_rows] = y
+                self.ready.put((x_buffer, y_buffer, n_rows))
+        except Exception:
+            self.ready.put(sys.exc_info())
+            return
+        self.ready.put(None)
+
+    def __iter__(self):
+        in_use = None
+        while True:
+            if in_use is not None:
+                self.free.put(in_use)
+            item = self.ready.get()
+            if item is None:
+                return
+            if isinstance(item[0], type) and issubclass(item[0], BaseException):
+                raise item[0], item[1], item[2]
+            in_use = item[:2]
+            yield item
@@ -0,0 +1,220 @@
+"""
+Streaming summaries of the predictive distribution. Samples are drawn in chunks and folded into
+running statistics, so only one chunk of the (m, n_samples, n_out) tensor is held in memory.
+"""
+import numpy as np
+
+
+def _weighted_quantiles(values, weights, ranks):
+    """
+    Weighted quantiles of every output of values.
+
+    :type values: numpy.array.
+    :param values: points of shape (n, ...).
+
+    :type weights: numpy.array.
+    :param weights: positive weight of each of the n points, the number of draws it stands for.
+
+    :type ranks: numpy.array.
+    :param ranks: increasing ranks in [0, sum(weights)] of the quantiles.
+
+    :returns: numpy.array of shape (len(ranks), ...) interpolated linearly between the points,
+            each placed at the middle of its weight.
+    """
+    n = values.shape[0]
+    if n == 1:
+        return np.repeat(values, len(ranks), axis=0)
+    order = np.argsort(values, axis=0)
+    values = np.take_along_axis(values, order, axis=0).reshape(n, -1).T
+    weights = weights[order].reshape(n, -1).T
+    positions = np.cumsum(weights, axis=1) - weights/2.
+    cells = np.arange(values.shape[0])[:, None]
+    ranks = np.clip(np.asarray(ranks, dtype=float)[None, :], positions[:, :1], positions[:, -1:])
+    #Offsetting the positions of each output by its index times the total weight puts them all in
+    #a single increasing array, so one searchsorted finds the points around every rank.
+    offsets = cells*(weights[0].sum() + 1.)
+    hi = np.searchsorted((positions + offsets).ravel(), (ranks + offsets).ravel())
+    hi = np.clip(hi.reshape(ranks.shape) - cells*n, 1, n - 1)
+    lo = hi - 1
+    frac = (ranks - positions[cells, lo])/(positions[cells, hi] - positions[cells, lo])
+    result = values[cells, lo] + frac*(values[cells, hi] - values[cells, lo])
+    return result.T.reshape((-1,) + order.shape[1:])
+
+
+class RunningSummary(object):
+    """
+    Running statistics of samples of shape (n_samples, n_out), updated with chunks of samples of
+    shape (chunk, n_samples, n_out):
+        - mean and variance, merged chunk by chunk with the parallel form of Welford's algorithm.
+        - quantiles, estimated from a quantile sketch of fixed size of each output. Up to
+          sketch_size draws the sketch holds the samples themselves and the quantiles are exact.
+          Then each chunk is merged into the sketch, which is compressed back to the sketch_size
+          quantiles at (i + 0.5)/sketch_size of the merged samples, weighted by the number of
+          draws each point stands for.
+        - histograms with fixed bins.
+    """
+    def __init__(self, sketch_size=None, bins=None, hist_range=None):
+        """
+        :type sketch_size: int.
+        :param sketch_size: number of points kept per output to estimate quantiles. If None no
+                            quantiles are computed.
+
+        :type bins: int.
+        :param bins: number of histogram bins. If None no histograms are computed.
+
+        :type hist_range: tuple of floats.
+        :param hist_range: (lower, upper) range of the histogram bins. Samples outside the range
+                        are counted in n_outside.
+        """
+        assert bins is None or hist_range is not None, "hist_range is required with bins."
+        assert sketch_size is None or sketch_size >= 1, "sketch_size must be at least 1: " \
+                                                                        "{0!r}".format(sketch_size)
+        self.sketch_size = sketch_size
+        self.bins = bins
+        self.hist_range = hist_range
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.sketch = None
+        self.histogram = None
+        self.n_outside = None
+
+    def update(self, samples):
+        """
+        :type samples: numpy.array.
+        :param samples: chunk of samples of shape (chunk, n_samples, n_out).
+        """
+        n = samples.shape[0]
+        chunk_mean = samples.mean(axis=0)
+        chunk_m2 = ((samples - chunk_mean)**2).sum(axis=0)
+        if self.count == 0:
+            self.mean = chunk_mean
+            self.m2 = chunk_m2
+        else:
+            delta = chunk_mean - self.mean
+            total = self.count + n
+            self.mean = self.mean + delta*n/total
+            self.m2 = self.m2 + chunk_m2 + delta**2*self.count*n/total
+
+        if self.sketch_size is not None:
+            self._update_sketch(samples)
+        if self.bins is not None:
+            self._update_histogram(samples)
+        self.count += n
+
+    def _update_sketch(self, samples):
+        if self.sketch is None:
+            values = samples
+            weights = np.ones(samples.shape[0])
+        else:
+            values = np.concatenate([self.sketch, samples])
+            #Every point of the sketch stands for the same number of draws.
+            weights = np.concatenate([np.repeat(self.count/float(self.sketch.shape[0]),
+                                                self.sketch.shape[0]), np.ones(samples.shape[0])])
+        if values.shape[0] <= self.sketch_size:
+            self.sketch = values
+        else:
+            total = self.count + samples.shape[0]
+            self.sketch = _weighted_quantiles(values, weights,
+                                (np.arange(self.sketch_size) + 0.5)/self.sketch_size*total)
+
+    def _update_histogram(self, samples):
+        lower, upper = self.hist_range
+        cells = int(np.prod(samples.shape[1:]))
+        if self.histogram is None:
+            self.histogram = np.zeros(cells*self.bins, dtype=np.int64)
+            self.n_outside = np.zeros(samples.shape[1:], dtype=np.int64)
+        idx = np.floor((samples - lower)/(upper - lower)*self.bins).astype(np.int64)
+        idx[samples == upper] = self.bins - 1
+        inside = (idx >= 0) & (idx < self.bins)
+        self.n_outside += (~inside).sum(axis=0)
+        flat = (np.arange(cells).reshape(samples.shape[1:])*self.bins + idx)[inside]
+        self.histogram += np.bincount(flat, minlength=self.histogram.size)
+
+    @property
+    def variance(self):
+        """Unbiased sample variance."""
+        return self.m2/max(self.count - 1, 1)
+
+    @property
+    def standard_error(self):
+        """Standard error of the mean estimate."""
+        return np.sqrt(self.variance/self.count)
+
+    def quantiles(self, q):
+        """
+        :type q: list of floats.
+        :param q: quantiles to compute, in [0, 1].
+
+        :returns: numpy.array of shape (len(q), n_samples, n_out).
+        """
+        q = np.asarray(q, dtype=float)
+        if self.count <= self.sketch_size:
+            return np.percentile(self.sketch, 100*q, axis=0)
+        n = self.sketch.shape[0]
+        return _weighted_quantiles(self.sketch, np.repeat(self.count/float(n), n), q*self.count)
+
+    def result(self, quantiles=None):
+        """Returns the statistics as a dict."""
+        result = {'n_draws': self.count, 'mean': self.mean, 'variance': self.variance,
+                  'standard_error': self.standard_error}
+        if quantiles is not None and self.sketch_size is not None:
+            result['quantiles'] = self.quantiles(quantiles)
+        if self.bins is not None:
+            result['histogram'] = self.histogram.reshape(self.mean.shape + (self.bins,))
+            result['bin_edges'] = np.linspace(self.hist_range[0], self.hist_range[1],
+                                                                                self.bins + 1)
+            result['n_outside'] = self.n_outside
+        return result
+
+
+def predict_summary(predict, x, m, m_chunk, quantiles=None, sketch_size=100, bins=None,
+                                                                        hist_range=None, tol=None):
+    """
+    Summarizes the predictive distribution of a network without holding all its samples.
+
+    :type predict: function.
+    :param predict: function (x, m) -> numpy.array of shape (m, n_samples, n_out), e.g.
+                    LBN.predict or NumpyLBN.predict.
+
+    :type x: numpy.array.
+    :param x: input data of shape (n_samples, n_in).
+
+    :type m: int.
+    :param m: maximum number of samples drawn from the network.
+
+    :type m_chunk: int.
+    :param m_chunk: number of samples drawn at once.
+
+    :type quantiles: list of floats.
+    :param quantiles: quantiles in [0, 1] to estimate.
+
+    :type sketch_size: int.
+    :param sketch_size: number of points per output of the quantile sketch, see RunningSummary.
+                        It is capped at m_chunk, so the sketch never holds more values than a
+                        chunk of samples: min(sketch_size, m_chunk)*n_samples*n_out. The
+                        quantiles are exact up to that many draws.
+
+    :type bins: int.
+    :param bins: number of histogram bins, None for no histogram.
+
+    :type hist_range: tuple of floats.
+    :param hist_range: (lower, upper) range of the histogram.
+
+    :type tol: float.
+    :param tol: if set, sampling stops once the standard error of every mean is below tol.
+
+    :returns: dict with 'n_draws', 'mean', 'variance' and 'standard_error' of shape
+            (n_samples, n_out), plus 'quantiles' and 'histogram', 'bin_edges', 'n_outside' when
+            requested.
+    """
+    summary = RunningSummary(min(sketch_size, m_chunk) if quantiles is not None else None, bins,
+                                                                                    hist_range)
+    drawn = 0
+    while drawn < m:
+        chunk = min(m_chunk, m - drawn)
+        summary.update(predict(x, chunk))
+        drawn += chunk
+        if tol is not None and drawn > 1 and np.max(summary.standard_error) < tol:
+            break
+    return summary.result(quantiles)
@@ -0,0 +1,223 @@
+"""
+Hyperparameter sweeps of LBN. The dataset is copied once into shared memory and the trials run in
+a pool of worker processes, each with its own compiled function cache directory, so that workers
+neither reload the data nor recompile a graph they compiled for a previous trial.
+
+Trials are scheduled by successive halving: every trial is trained for min_epochs epochs, the
+best 1/eta of them by log likelihood are trained eta times longer, and so on until the survivors
+reach epochs. Training resumes from the checkpoint of the previous rung, so a promoted trial
+gives the same result as if it had been trained in one call. The best weights of each trial are
+saved as a binary checkpoint.
+
+A configuration is a dict with the architecture (n_hidden, det_activations, stoch_activations and
+optionally stoch_n_hidden and noise) and the training settings (m, learning_rate, batch_size and
+optionally any other argument of LBN.fit()).
+
+Usage:
+    python sweep.py data.npz configs.json output_dir [--workers 4] [--epochs 27] [--eta 3]
+                                                     [--min-epochs 1]
+
+data.npz holds the arrays x and y and optionally x_valid and y_valid. configs.json is a list of
+configurations. The results table is written to output_dir/results.json.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+import numpy as np
+import theano
+from function_cache import FunctionCache
+from lbn import LBN
+from parallel import buffer_views
+
+ARCHITECTURE_KEYS = ('n_hidden', 'det_activations', 'stoch_activations', 'stoch_n_hidden',
+                     'noise')
+
+#Dataset views and function cache of a worker process, set by _init_worker().
+_worker_data = None
+_worker_cache = None
+
+
+def grid(axes):
+    """
+    Returns the configurations of all the combinations of the values of axes.
+
+    :type axes: dict.
+    :param axes: list of values of each key of the configuration.
+    """
+    keys = sorted(axes)
+    return [dict(zip(keys, values)) for values in itertools.product(*[axes[k] for k in keys])]
+
+
+def _init_worker(buffer, shapes, cache_dir, counter):
+    global _worker_data, _worker_cache
+    _worker_data = buffer_views(buffer, shapes)
+    with counter.get_lock():
+        worker_id = counter.value
+        counter.value += 1
+    if cache_dir is not None:
+        _worker_cache = FunctionCache(os.path.join(cache_dir, 'worker-{0}'.format(worker_id)))
+
+
+def _run_trial(args):
+    """Trains a trial up to epochs in a worker process and returns its results."""
+    trial_id, config, epochs, trial_dir = args
+    x, y = _worker_data[:2]
+    validation = tuple(_worker_data[2:]) or None
+    architecture = dict((k, v) for k, v in config.items() if k in ARCHITECTURE_KEYS)
+    settings = dict((k, v) for k, v in config.items() if k not in ARCHITECTURE_KEYS)
+    result = {'trial': trial_id, 'config': config, 'epochs': epochs}
+    try:
+        net = LBN(x.shape[1], architecture.pop('n_hidden'), y.shape[1],
+                    architecture.pop('det_activations'), architecture.pop('stoch_activations'),
+                    function_cache=_worker_cache, **architecture)
+        history = net.fit(x, y, settings.pop('m'), settings.pop('learning_rate'), epochs,
+                    settings.pop('batch_size'), validation=validation, restore_best=True,
+                    save_fname=None, checkpoint_dir=os.path.join(trial_dir, 'checkpoint'),
+                    resume=True, **settings)
+        best_fname = os.path.join(trial_dir, 'best')
+        net.save_network(best_fname, binary=True)
+        evaluated = [h['log_likelihood'] for h in history if h['log_likelihood'] is not None]
+        result.update(status='ok', final_log_likelihood=evaluated[-1],
+                      best_log_likelihood=net.best_log_likelihood, best_epoch=net.best_epoch,
+                      time_per_epoch=float(np.mean([h['train_time'] + h['eval_time']
+                                                                        for h in history])),
+                      best_checkpoint=best_fname)
+    except Exception:
+        result.update(status='failed', error=traceback.format_exc(),
+                      best_log_likelihood=-np.inf)
+    return result
+
+
+def rungs(epochs, min_epochs=1, eta=3):
+    """Epochs of training reached at each rung of successive halving."""
+    budgets = []
+    budget = min_epochs
+    while budget < epochs:
+        budgets.append(budget)
+        budget *= eta
+    return budgets + [epochs]
+
+
+def run_sweep(configs, x, y, epochs, output_dir, validation=None, n_workers=None, eta=3,
+                                                                min_epochs=1, cache_dir=None):
+    """
+    Runs the configurations with successive halving and returns the results table.
+
+    :type configs: list of dicts.
+    :param configs: configurations to train, see the module documentation.
+
+    :type x: numpy.array.
+    :param x: training input of shape (n_samples, n_in).
+
+    :type y: numpy.array.
+    :param y: training output of shape (n_samples, n_out).
+
+    :type epochs: int.
+    :param epochs: epochs of the trials that reach the last rung.
+
+    :type output_dir: string.
+    :param output_dir: directory of the checkpoints of each trial and of results.json.
+
+    :type validation: tuple of numpy.array.
+    :param validation: (x, y) held-out set on which trials are evaluated and compared. Without it
+                    the log likelihood of the training set is used.
+
+    :type n_workers: int.
+    :param n_workers: number of worker processes, by default the number of CPUs.
+
+    :type eta: int.
+    :param eta: at each rung the best 1/eta of the trials are kept and trained eta times longer.
+
+    :type min_epochs: int.
+    :param min_epochs: epochs of the first rung.
+
+    :type cache_dir: string.
+    :param cache_dir: directory of the compiled function caches of the workers, by default
+                    output_dir/function_cache.
+
+    :returns: list with a dict per trial sorted by best log likelihood: trial, config, status,
+            epochs trained, final_log_likelihood, best_log_likelihood, best_epoch,
+            time_per_epoch (seconds, train and evaluation) and best_checkpoint, or error for
+            failed trials.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    cache_dir = os.path.join(output_dir, 'function_cache') if cache_dir is None else cache_dir
+    arrays = [x, y] + ([] if validation is None else list(validation))
+    arrays = [np.asarray(a, dtype=theano.config.floatX) for a in arrays]
+    typecode = 'f' if theano.config.floatX == 'float32' else 'd'
+    buffer = multiprocessing.RawArray(typecode, sum(a.size for a in arrays))
+    for view, a in zip(buffer_views(buffer, [a.shape for a in arrays]), arrays):
+        view[...] = a
+
+    pool = multiprocessing.Pool(n_workers, _init_worker, (buffer, [a.shape for a in arrays],
+                                                        cache_dir, multiprocessing.Value('i', 0)))
+    results = {}
+    alive = range(len(configs))
+    try:
+        budgets = rungs(epochs, min_epochs, eta)
+        for r, budget in enumerate(budgets):
+            print "Rung {0}: training {1} trials to {2} epochs".format(r, len(alive), budget)
+            tasks = [(i, configs[i], budget, os.path.join(output_dir, 'trial-{0}'.format(i)))
+                                                                                for i in alive]
+            for result in pool.map(_run_trial, tasks, chunksize=1):
+                results[result['trial']] = result
+            if r + 1 < len(budgets):
+                ranked = sorted(alive, key=lambda i: results[i]['best_log_likelihood'],
+                                                                                reverse=True)
+                alive = [i for i in ranked[:max(1, len(ranked) // eta)]
+                                                            if results[i]['status'] == 'ok']
+    finally:
+        pool.close()
+        pool.join()
+
+    table = sorted(results.values(), key=lambda res: res['best_log_likelihood'], reverse=True)
+    with open(os.path.join(output_dir, 'results.json'), 'w') as f:
+        json.dump(table, f, indent=1, sort_keys=True)
+    print format_table(table)
+    return table
+
+
+def format_table(results):
+    """Returns the results of run_sweep() as a text table."""
+    lines = ["{0:>5} {1:>6} {2:>7} {3:>14} {4:>14} {5:>10}  {6}".format('trial', 'status',
+                'epochs', 'final LL', 'best LL', 's/epoch', 'config')]
+    for res in results:
+        if res['status'] != 'ok':
+            lines.append("{0:>5} {1:>6} {2:>7} {3:>14} {4:>14} {5:>10}  {6}".format(res['trial'],
+                            res['status'], res['epochs'], '-', '-', '-',
+                            json.dumps(res['config'], sort_keys=True)))
+            continue
+        lines.append("{0:>5} {1:>6} {2:>7} {3:>14.4f} {4:>14.4f} {5:>10.3f}  {6}".format(
+                    res['trial'], res['status'], res['epochs'], res['final_log_likelihood'],
+                    res['best_log_likelihood'], res['time_per_epoch'],
+                    json.dumps(res['config'], sort_keys=True)))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="LBN hyperparameter sweep.")
+    parser.add_argument('data', help="npz file with x, y and optionally x_valid, y_valid")
+    parser.add_argument('configs', help="JSON file with the list of configurations")
+    parser.add_argument('output_dir')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=27)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--min-epochs', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    data = np.load(args.data)
+    validation = (data['x_valid'], data['y_valid']) if 'x_valid' in data.files else None
+    with open(args.configs) as f:
+        configs = json.load(f)
+    run_sweep(configs, data['x'], data['y'], args.epochs, args.output_dir, validation,
+                            n_workers=args.workers, eta=args.eta, min_epochs=args.min_epochs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
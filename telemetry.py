@@ -0,0 +1,189 @@
+"""
+Instrumentation of the training loops of LBN. A Telemetry object times the compile, train and
+evaluation phases, computes throughput and peak memory and forwards per-minibatch and per-epoch
+events to callbacks. Callbacks are objects with any of the methods of Callback.
+"""
+import contextlib
+import json
+import resource
+import sys
+import time
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes and OS X bytes.
+    return rss if sys.platform == 'darwin' else rss*1024
+
+
+class Callback(object):
+    """Base class of the training callbacks. All methods do nothing by default."""
+    def on_train_begin(self, info):
+        """
+        :type info: dict.
+        :param info: training settings (m, batch_size, epochs, n_train, ...) and compile_time.
+        """
+        pass
+
+    def on_batch_end(self, epoch, batch, log_likelihood, n_examples):
+        pass
+
+    def on_epoch_end(self, epoch, metrics):
+        """
+        :type metrics: dict.
+        :param metrics: metrics of the epoch, see Telemetry.epoch_end().
+        """
+        pass
+
+    def on_train_end(self, history):
+        """
+        :type history: list of dicts.
+        :param history: metrics of every epoch.
+        """
+        pass
+
+
+class MetricsLogger(Callback):
+    """Writes one JSON object per line to fname: a 'train_begin' record and one per epoch."""
+    def __init__(self, fname, log_batches=False):
+        """
+        :type fname: string.
+        :param fname: file where the metrics are appended.
+
+        :type log_batches: bool.
+        :param log_batches: if True the log likelihood of every minibatch is also written.
+        """
+        self.fname = fname
+        self.log_batches = log_batches
+        self.f = None
+
+    def _write(self, record):
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def on_train_begin(self, info):
+        self.f = open(self.fname, 'a')
+        self._write(dict(info, event='train_begin', time=time.time()))
+
+    def on_batch_end(self, epoch, batch, log_likelihood, n_examples):
+        if self.log_batches:
+            self._write({'event': 'batch', 'epoch': epoch, 'batch': batch,
+                         'log_likelihood': float(log_likelihood), 'n_examples': n_examples})
+
+    def on_epoch_end(self, epoch, metrics):
+        self._write(dict(metrics, event='epoch', time=time.time()))
+
+    def on_train_end(self, history):
+        self.f.close()
+        self.f = None
+
+
+class LikelihoodPlot(Callback):
+    """
+    Plots the log likelihood of each epoch at the end of training. matplotlib is imported only
+    here. The plot is saved to fname if given, otherwise it is shown without blocking.
+    """
+    def __init__(self, fname=None):
+        self.fname = fname
+
+    def on_train_end(self, history):
+        history = [h for h in history if h['log_likelihood'] is not None]
+        epochs = [h['epoch'] for h in history]
+        log_likelihood = [h['log_likelihood'] for h in history]
+        if self.fname is None:
+            import matplotlib.pyplot as plt
+            plt.figure()
+            plt.plot(epochs, log_likelihood)
+            plt.xlabel('epoch')
+            plt.ylabel('log likelihood')
+            plt.show(block=False)
+        else:
+            #Drawn without pyplot so that no display is needed.
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            figure = Figure()
+            FigureCanvasAgg(figure)
+            axes = figure.add_subplot(111)
+            axes.plot(epochs, log_likelihood)
+            axes.set_xlabel('epoch')
+            axes.set_ylabel('log likelihood')
+            figure.savefig(self.fname)
+
+
+class Telemetry(object):
+    """
+    Collects the timings and metrics of a training run and dispatches them to callbacks.
+    """
+    def __init__(self, callbacks=None, metrics_log=None, plot=False):
+        """
+        :type callbacks: list of Callback.
+        :param callbacks: objects notified of the training events.
+
+        :type metrics_log: string.
+        :param metrics_log: if set, the metrics are written to this JSONL file.
+
+        :type plot: bool or string.
+        :param plot: if True the log likelihood is plotted without blocking at the end. If a
+                    string, the plot is saved to that file.
+        """
+        self.callbacks = list(callbacks or [])
+        if metrics_log is not None:
+            self.callbacks.append(MetricsLogger(metrics_log))
+        if plot:
+            self.callbacks.append(LikelihoodPlot(None if plot is True else plot))
+        self.batch_callbacks = [c for c in self.callbacks if hasattr(c, 'on_batch_end')]
+        self.timings = {'compile': 0., 'train': 0., 'eval': 0.}
+        self.history = []
+        self.m = None
+        self._epoch_start = None
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Adds the time spent in the with block to the given phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.time() - start
+
+    def _notify(self, event, *args):
+        for c in self.callbacks:
+            if hasattr(c, event):
+                getattr(c, event)(*args)
+
+    def train_begin(self, **info):
+        """Called after compiling, with the training settings (m is required)."""
+        self.m = info['m']
+        self._notify('on_train_begin', dict(info, compile_time=self.timings['compile']))
+        self._epoch_start = dict(self.timings)
+
+    def batch_end(self, epoch, batch, log_likelihood, n_examples):
+        for c in self.batch_callbacks:
+            c.on_batch_end(epoch, batch, log_likelihood, n_examples)
+
+    def epoch_end(self, epoch, log_likelihood, n_examples, **extra):
+        """
+        Builds the metrics of the epoch: log likelihood (None if it was not evaluated), train and
+        eval time of the epoch, examples/sec and samples/sec (examples times m) of training,
+        cumulated compile time, peak RSS in bytes and the extra metrics given. Returns them after
+        notifying the callbacks.
+        """
+        train_time = self.timings['train'] - self._epoch_start['train']
+        eval_time = self.timings['eval'] - self._epoch_start['eval']
+        metrics = {'epoch': epoch,
+                   'log_likelihood': None if log_likelihood is None else float(log_likelihood),
+                   'train_time': train_time, 'eval_time': eval_time,
+                   'compile_time': self.timings['compile'],
+                   'examples_per_sec': n_examples/train_time if train_time > 0 else None,
+                   'samples_per_sec': n_examples*self.m/train_time if train_time > 0 else None,
+                   'peak_rss': peak_rss()}
+        metrics.update((k, float(v)) for k, v in extra.items())
+        self.history.append(metrics)
+        self._notify('on_epoch_end', epoch, metrics)
+        self._epoch_start = dict(self.timings)
+        return metrics
+
+    def train_end(self):
+        self._notify('on_train_end', self.history)
+        return self.history
@@ -0,0 +1,99 @@
+"""
+Round trip of a saved network through the JSON and binary checkpoint formats. Run with
+python -m unittest test_checkpoint or python -m pytest.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import theano
+import checkpoint
+from lbn import LBN
+
+
+class CheckpointRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.x = np.random.RandomState(0).randn(6, 4).astype(theano.config.floatX)
+        self.net = LBN(4, [5, 3], 2, ['linear']*3, ['sigmoid', 'sigmoid'])
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def layers(self, net):
+        """Returns (no_bias, W, b) of every deterministic layer of net."""
+        layers = []
+        for l in net.hidden_layers:
+            layers.extend([l.det_layer] + l.stoch_layer.hidden_layers)
+        return [(d.no_bias, d.W, None if d.no_bias else d.b) for d in layers]
+
+    def test_json_to_binary_mmap(self):
+        json_fname = os.path.join(self.dirname, 'network.json')
+        binary_dirname = os.path.join(self.dirname, 'network')
+        self.net.save_network(json_fname)
+        checkpoint.convert(json_fname, binary_dirname)
+        with open(os.path.join(binary_dirname, checkpoint.MANIFEST)) as f:
+            manifest = json.load(f)
+        det = manifest['layers']['hidden_layers'][0]['LBNlayer']['detLayer']
+        stoch = manifest['layers']['hidden_layers'][0]['LBNlayer']['stochLayer'][0]['detLayer']
+        self.assertIsNone(det['b'])
+        self.assertEqual(stoch['b'].keys(), ['npy'])
+
+        loaded = LBN.init_from_file(binary_dirname, mmap=True)
+        layers = self.layers(loaded)
+        #Both the layers without bias, the deterministic ones, and the layers with bias, those of
+        #the stochastic MLPs, are checked.
+        self.assertEqual(sorted(set(no_bias for no_bias, _, _ in layers)), [False, True])
+        for (no_bias, W, b), (_, W_expected, b_expected) in zip(layers, self.layers(self.net)):
+            np.testing.assert_array_equal(W.get_value(), W_expected.get_value())
+            self.assertIsInstance(W.get_value(borrow=True).base, np.memmap)
+            if not no_bias:
+                np.testing.assert_array_equal(b.get_value(), b_expected.get_value())
+                self.assertIsInstance(b.get_value(borrow=True).base, np.memmap)
+        np.testing.assert_array_equal(loaded.output_layer.W.get_value(),
+                                                                self.net.output_layer.W.get_value())
+        self.net.seed(3)
+        loaded.seed(3)
+        np.testing.assert_array_equal(loaded.predict(self.x, 4), self.net.predict(self.x, 4))
+
+        #The mapping is copy-on-write: writes change neither the files nor other loads.
+        loaded.output_layer.W.get_value(borrow=True)[...] = 0
+        again = LBN.init_from_file(binary_dirname, mmap=True)
+        np.testing.assert_array_equal(again.output_layer.W.get_value(),
+                                                                self.net.output_layer.W.get_value())
+
+    def test_description_is_copied(self):
+        description = self.net.network_description()
+        first, second = [LBN.from_description(description) for _ in xrange(2)]
+        first.output_layer.W.get_value(borrow=True)[...] = 0
+        self.assertTrue(np.all(second.output_layer.W.get_value() != 0))
+        self.assertTrue(np.all(description['layers']['output_layer']['W'] != 0))
+
+    def test_interrupted_atomic_save(self):
+        dirname = os.path.join(self.dirname, 'checkpoint')
+        description = self.net.network_description()
+        checkpoint.save_binary(description, dirname, atomic=True)
+        #State left by a save interrupted between its two renames.
+        os.rename(dirname, dirname + '.old')
+        checkpoint.save_binary(description, dirname + '.tmp')
+        self.assertTrue(checkpoint.is_binary_checkpoint(dirname))
+        np.testing.assert_array_equal(checkpoint.load(dirname)['layers']['output_layer']['W'],
+                                                        description['layers']['output_layer']['W'])
+        #The next save keeps the previous checkpoint until the new one replaces it.
+        checkpoint.save_binary(description, dirname, atomic=True)
+        self.assertTrue(checkpoint.is_binary_checkpoint(dirname))
+        self.assertFalse(os.path.exists(dirname + '.old'))
+        self.assertFalse(os.path.exists(dirname + '.tmp'))
+
+    def test_resume_from_missing_checkpoint(self):
+        x = np.zeros((4, 4), dtype=theano.config.floatX)
+        y = np.zeros((4, 2), dtype=theano.config.floatX)
+        self.assertRaises(ValueError, self.net.fit, x, y, 2, 0.1, 1, 2,
+                            save_fname=os.path.join(self.dirname, 'network.json'),
+                            resume=os.path.join(self.dirname, 'missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Start up costs of lbn: importing it does not import matplotlib, and constructing an LBN neither
+builds its graph nor compiles anything until they are first used. Run with
+python -m unittest test_lbn or python -m pytest.
+"""
+import os
+import subprocess
+import sys
+import time
+import unittest
+import numpy as np
+from lbn import LBN
+
+#Upper bound in seconds of the construction of the network below, which takes about 1ms. Building
+#the graph and compiling predict eagerly took seconds.
+MAX_CONSTRUCT_TIME = 0.5
+
+
+class StartupTest(unittest.TestCase):
+    def network(self):
+        return LBN(10, [50, 50], 2, ['linear']*3, ['sigmoid', 'sigmoid'])
+
+    def test_import_does_not_import_matplotlib(self):
+        #In a fresh process, since the test runner may have imported matplotlib already.
+        out = subprocess.check_output([sys.executable, '-c',
+                                    "import sys, lbn; print 'matplotlib' in sys.modules"],
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.strip().split('\n')[-1], 'False')
+
+    def test_construction_is_lazy(self):
+        net = self.network()
+        built = [name for name in LBN.GRAPH_ATTRIBUTES + tuple(LBN.LAZY_FUNCTIONS)
+                                                                        if name in net.__dict__]
+        self.assertEqual(built, [])
+        #First use builds the graph and compiles predict.
+        samples = net.predict(np.zeros((3, 10)), 4)
+        self.assertEqual(samples.shape, (4, 3, 2))
+        self.assertIn('hidden_layers', net.__dict__)
+        self.assertIn('predict', net.__dict__)
+
+    def test_construction_time(self):
+        self.network()
+        start = time.time()
+        self.network()
+        self.assertLess(time.time() - start, MAX_CONSTRUCT_TIME)
+
+
+if __name__ == '__main__':
+    unittest.main()
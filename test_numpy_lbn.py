@@ -0,0 +1,56 @@
+"""
+Parity of the NumPy inference engine with the Theano predict. Run with python -m unittest
+test_numpy_lbn or python -m pytest.
+"""
+import unittest
+import numpy as np
+import theano
+from lbn import LBN
+from numpy_lbn import NumpyLBN
+
+
+class NumpyLBNParityTest(unittest.TestCase):
+    #(n_hidden, stoch_n_hidden) of the networks compared.
+    ARCHITECTURES = [([5], [-1]), ([6, 4], [-1]), ([6, 4], [3, -1])]
+    GATES = ('bool', 'uint8', 'packed')
+
+    def setUp(self):
+        self.x = np.random.RandomState(0).randn(7, 3).astype(theano.config.floatX)
+
+    def network(self, n_hidden, stoch_n_hidden):
+        return LBN(3, n_hidden, 2, ['tanh']*len(n_hidden) + ['linear'],
+                    ['sigmoid']*(len(stoch_n_hidden) + 1), stoch_n_hidden=stoch_n_hidden)
+
+    def assert_parity(self, net, numpy_net, m, seed):
+        net.seed(seed)
+        numpy_net.seed(seed)
+        #Two calls in a row, so that the streams also advance in the same way.
+        for _ in xrange(2):
+            expected = net.predict(self.x, m)
+            samples = numpy_net.predict(self.x, m)
+            self.assertEqual(samples.shape, (m, self.x.shape[0], 2))
+            np.testing.assert_allclose(samples, expected, rtol=1e-7, atol=1e-10)
+
+    def test_predict_matches_theano(self):
+        for n_hidden, stoch_n_hidden in self.ARCHITECTURES:
+            net = self.network(n_hidden, stoch_n_hidden)
+            description = net.network_description()
+            for gates in self.GATES:
+                #A small noise_chunk makes the compact modes draw the noise in several chunks.
+                numpy_net = NumpyLBN(description, gates=gates, noise_chunk=11,
+                                                                dtype=theano.config.floatX)
+                self.assert_parity(net, numpy_net, 5, seed=42)
+
+    def test_compact_gates_match(self):
+        description = self.network([6, 4], [-1]).network_description()
+        compact = [NumpyLBN(description, gates=gates, noise_chunk=11) for gates in ('uint8',
+                                                                                    'packed')]
+        for numpy_net in compact:
+            numpy_net.predict(self.x, 5)
+        for k in xrange(2):
+            np.testing.assert_array_equal(compact[0].unpacked_gates(k),
+                                                                compact[1].unpacked_gates(k))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import theano
+import theano.sparse
 import theano.tensor as T
 
 
@@ -43,3 +45,10 @@ def parse_activations(activations):
         sigma[i] = get_activation_function(a)
         sigma_prime[i] = get_activation_derivative(a)
     return sigma, sigma_prime
+
+
+def dot(x, y):
+    """T.dot that also accepts a sparse x, the input of a network built with sparse=True."""
+    if isinstance(x.type, theano.sparse.SparseType):
+        return theano.sparse.dot(x, y)
+    return T.dot(x, y)